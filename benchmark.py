@@ -0,0 +1,934 @@
+#coding=utf-8
+
+"""
+Offline benchmarks for tar_data_collection.py, run on synthetic data.
+
+Usage
+----------
+ python benchmark.py trec_format --num 20000
+ python benchmark.py pids
+ python benchmark.py driver_pool --num 20
+ python benchmark.py extract --num 100000 --workers 4
+ python benchmark.py suite --topics 4 --num 5000 --save-baseline
+ python benchmark.py suite --topics 4 --num 5000
+ python benchmark.py evaluate --runs 200 --topics 20 --num 2000
+
+Benchmarks
+----------
+ trec_format                  --- minidom vs iterparse TRECTEXT formatting: time, peak RSS, identical output
+ pids                         --- list vs set pid dedup at 10k, 100k and 1M pids
+ driver_pool                  --- fresh browser per topic vs DriverPool, with a fake driver
+ extract                      --- serial vs parallel extract_pid over synthetic Ovid exports
+ suite                        --- ops/sec and peak RSS of the pipeline stages on synthetic fixtures,
+                                  compared with a stored baseline
+ evaluate                     --- per-topic loop vs vectorized TAR evaluation of synthetic runs, same values
+
+"""
+
+
+import os
+import sys
+import csv
+import math
+import json
+import time
+import random
+import codecs
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from collections import defaultdict
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:  # python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+import numpy as np
+
+import tar_data_collection as tdc
+
+
+WORDS = [u'randomised', u'controlled', u'trial', u'patients', u'diagnostic', u'accuracy', u'sensitivity',
+         u'specificity', u'cohort', u'outcome', u'therapy', u'placebo', u'meta-analysis', u'review',
+         u'children', u'adults', u'mortality', u'risk', u'dose', u'screening', u'Ménière', u'α-synuclein']
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process
+    :return: float, MB
+    """
+    if resource is None:
+        return float('nan')
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if 'darwin' == sys.platform:  # bytes on mac
+        kb /= 1024.0
+    return kb / 1024.0
+
+
+def _process_target(queue, func, args):
+    try:
+        queue.put((True, func(args)))
+    except Exception as e:
+        queue.put((False, '{}: {}'.format(type(e).__name__, e)))
+        raise
+
+
+def run_in_process(func, args):
+    """
+    Run func(args) in a fresh, non-daemonic process, so that peak RSS is its own and it may start workers
+    :param func: module level function
+    :param args:
+    :return: result of func
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_process_target, args=(queue, func, args))
+    process.start()
+    ok, result = queue.get()
+    process.join()
+    if not ok:
+        raise RuntimeError('{} failed in its process: {}'.format(func.__name__, result))
+    return result
+
+
+def random_text(rng, n):
+    return u' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+PUBMED_ARTICLE_SET_HEAD = (u'<?xml version="1.0" ?>\n'
+                           u'<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" '
+                           u'"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">\n'
+                           u'<PubmedArticleSet>\n')
+
+
+def pubmed_article(rng, pid):
+    """
+    A synthetic PubmedArticle with inline markup, a structured abstract and non-ascii text
+    :param rng: random.Random
+    :param pid: int
+    :return: unicode
+    """
+    lines = [u'<PubmedArticle>\n  <MedlineCitation Status="MEDLINE" Owner="NLM">\n',
+             u'    <PMID Version="1">{}</PMID>\n'.format(pid),
+             u'    <Article PubModel="Print">\n',
+             u'      <ArticleTitle>{} <i>{}</i> &amp; {}.</ArticleTitle>\n'.format(
+                 random_text(rng, 6), random_text(rng, 2), random_text(rng, 3))]
+    section = rng.randint(0, 4)
+    if section:
+        lines.append(u'      <Abstract>\n')
+        for label in [u'BACKGROUND', u'METHODS', u'RESULTS', u'CONCLUSIONS'][:section]:
+            lines.append(u'        <AbstractText Label="{}">{} <sup>2</sup> {}</AbstractText>\n'.format(
+                label, random_text(rng, 40), random_text(rng, 20)))
+        lines.append(u'      </Abstract>\n')
+    lines.append(u'    </Article>\n')
+    lines.append(u'    <CommentsCorrectionsList><CommentsCorrections RefType="Cites">'
+                 u'<PMID Version="1">{}</PMID></CommentsCorrections></CommentsCorrectionsList>\n'.format(pid - 1))
+    lines.append(u'  </MedlineCitation>\n</PubmedArticle>\n')
+    return u''.join(lines)
+
+
+def make_pubmed_article_set(path, num, seed=0, first=10000000):
+    """
+    Write a synthetic efetch response of pids first .. first + num - 1
+    :param path: str
+    :param num: int, article num
+    :param seed: int
+    :param first: int, first pid
+    :return:
+    """
+    rng = random.Random(seed)
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(PUBMED_ARTICLE_SET_HEAD)
+        for pid in range(first, first + num):
+            f.write(pubmed_article(rng, pid))
+        f.write(u'</PubmedArticleSet>\n')
+    return
+
+
+def make_efetch_response(pids):
+    """
+    A synthetic efetch response for a list of pids, the same for the same pid
+    :param pids: list of str
+    :return: bytes
+    """
+    body = u''.join(pubmed_article(random.Random(int(pid)), int(pid)) for pid in pids)
+    return (PUBMED_ARTICLE_SET_HEAD + body + u'</PubmedArticleSet>\n').encode('utf-8')
+
+
+class StubEfetchHandler(BaseHTTPRequestHandler):
+    """
+    Answers efetch GET and POST requests with make_efetch_response
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, query):
+        content = make_efetch_response(query['id'][0].split(','))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.respond(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+
+class StubEfetchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_efetch_server():
+    """
+    Start a local efetch server in a background thread
+    :return: tuple, (server, url). Stop it with server.shutdown().
+    """
+    server = StubEfetchServer(('127.0.0.1', 0), StubEfetchHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}/efetch.fcgi'.format(server.server_port)
+
+
+def _run_trec_format(args):
+    src, dst, parser = args
+    start_time = time.time()
+    tdc.trec_format_file(src, dst, parser=parser)
+    return time.time() - start_time, peak_rss_mb()
+
+
+def bench_trec_format(num):
+    """
+    Compare the minidom and the iterparse formatter on one large file.
+    Every parser runs in a fresh process, so peak RSS is not shared.
+    :param num: int, article num
+    :return:
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp_dir, 'corpus.xml')
+        make_pubmed_article_set(src, num)
+        print('synthetic PubmedArticleSet: {} articles, {:.1f} MB'.format(num, os.path.getsize(src) / 1048576.0))
+
+        results = {}
+        for parser in ['minidom', 'iterparse']:
+            elapsed, rss = run_in_process(_run_trec_format, (src, os.path.join(tmp_dir, parser), parser))
+            results[parser] = elapsed
+            print('{:<10} | {:>8.2f} s | {:>10.1f} docs/sec | peak RSS {:>8.1f} MB'.format(
+                parser, elapsed, num / elapsed, rss))
+
+        with open(os.path.join(tmp_dir, 'minidom'), 'rb') as f1, open(os.path.join(tmp_dir, 'iterparse'), 'rb') as f2:
+            identical = f1.read() == f2.read()
+        print('speedup: {:.2f}x, identical output: {}'.format(results['minidom'] / results['iterparse'], identical))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return
+
+
+def make_pids_file(path, num, seed=0, first=20000000):
+    """
+    Write a synthetic pids file with about 10% duplicate pids
+    :param path: str
+    :param num: int, pid num
+    :param seed: int
+    :param first: int, smallest pid
+    :return:
+    """
+    rng = random.Random(seed)
+    with codecs.open(path, 'w', 'utf-8') as f:
+        for i in range(num):
+            pid = first + (rng.randint(0, i) if i and rng.random() < 0.1 else i)
+            f.write(u'{}\n'.format(pid))
+    return
+
+
+def make_relevance_index(path, dict_pids, seed=0):
+    """
+    Write a synthetic relevance_index.csv: about 10% of the pids of a review are judged,
+    a fifth of those included, and some judged pids are outside the review's pids
+    :param path: str
+    :param dict_pids: dict, review_doi -> list of pids
+    :param seed: int
+    :return: int, row num
+    """
+    rng = random.Random(seed)
+    row_num = 0
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['review_doi', 'pubmed_id', 'ref_type', 'study_id'])
+        for review_doi, pids in sorted(dict_pids.items()):
+            for pid in pids:
+                if rng.random() >= 0.1:
+                    continue
+                ref_type = rng.choice(['included', 'excluded', 'excluded', 'excluded', 'excluded', 'additional'])
+                writer.writerow(['10.1002/14651858.{}.pub2'.format(review_doi), pid, ref_type, row_num])
+                row_num += 1
+            for _ in range(len(pids) // 100):
+                writer.writerow(['10.1002/14651858.{}.pub2'.format(review_doi), rng.randint(1, 9999999), 'excluded',
+                                 row_num])
+                row_num += 1
+    return row_num
+
+
+def unique_pids_list(pids):
+    """
+    The previous list-based dedup, kept for comparison
+    """
+    list_boolean = []
+    local = []
+    for l in pids:
+        if l not in local:
+            list_boolean.append(l)
+            local.append(l)
+    return list_boolean
+
+
+def bench_pids(sizes, list_max):
+    """
+    Time reading and deduplicating a pids file
+    :param sizes: list of int, pid num
+    :param list_max: int, largest size the quadratic list dedup is run on
+    :return:
+    """
+    tmp_dir = tempfile.mkdtemp()
+    old_pids_dir = tdc.PIDS_DIR
+    tdc.PIDS_DIR = tmp_dir
+    try:
+        for num in sizes:
+            topic_id = str(num)
+            make_pids_file(os.path.join(tmp_dir, topic_id), num)
+
+            start_time = time.time()
+            list_set = tdc.read_pids(topic_id)
+            set_time = time.time() - start_time
+
+            start_time = time.time()
+            tdc.read_pids(topic_id)
+            cached_time = time.time() - start_time
+
+            if num <= list_max:
+                start_time = time.time()
+                with codecs.open(os.path.join(tmp_dir, topic_id), 'r', 'utf-8') as fr:
+                    list_list = unique_pids_list(l.strip() for l in fr)
+                list_time = '{:>10.3f} s'.format(time.time() - start_time)
+                assert list_list == list_set
+            else:
+                list_time = '{:>12}'.format('skipped')
+
+            print('{:>8} pids | {} unique | list {} | set {:>8.3f} s | cached {:>8.6f} s'.format(
+                num, len(list_set), list_time, set_time, cached_time))
+    finally:
+        tdc.PIDS_DIR = old_pids_dir
+        shutil.rmtree(tmp_dir)
+    return
+
+
+def make_ovid_export(path, first, num, seed=0):
+    """
+    Write a synthetic Ovid export xml with records first .. first + num - 1
+    :param path: str
+    :param first: int, index of the first record
+    :param num: int, record num
+    :param seed: int
+    :return:
+    """
+    rng = random.Random(seed)
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<records>\n')
+        for inx in range(first, first + num):
+            f.write(u'<record index="{}">\n'.format(inx))
+            f.write(u'<F L="Unique Identifier" C="UI"><D type="s">{}</D></F>\n'.format(30000000 + inx))
+            f.write(u'<F L="Title" C="TI"><D type="s">{}</D></F>\n'.format(random_text(rng, 12)))
+            f.write(u'<F L="Source" C="SO"><D type="s">{}</D></F>\n'.format(random_text(rng, 6)))
+            f.write(u'<F L="Date Created" C="DC"><D type="s">{:04d}{:02d}{:02d}</D></F>\n'.format(
+                rng.randint(1990, 2019), rng.randint(1, 12), rng.randint(1, 28)))
+            f.write(u'</record>\n')
+        f.write(u'</records>\n')
+    return
+
+
+def make_ovid_topic(download_pids_dir, topic_id, num, seed=0):
+    """
+    Write the Ovid exports of one topic, DOWNLOAD_NUM_PER_TIME records per file
+    :param download_pids_dir: str
+    :param topic_id: str
+    :param num: int, record num
+    :param seed: int
+    :return:
+    """
+    topic_dir = os.path.join(download_pids_dir, topic_id)
+    os.makedirs(topic_dir)
+    for i, first in enumerate(range(1, num + 1, tdc.DOWNLOAD_NUM_PER_TIME)):
+        make_ovid_export(os.path.join(topic_dir, 'export{}.xml'.format(i)), first,
+                         min(tdc.DOWNLOAD_NUM_PER_TIME, num + 1 - first), seed + i)
+    return
+
+
+def use_tmp_dirs(tmp_dir):
+    """
+    Point the pipeline directories of tar_data_collection to tmp_dir
+    :param tmp_dir: str
+    :return:
+    """
+    for name in ['DOWNLOAD_PIDS_DIR', 'PIDS_DIR', 'TOPIC_DIR', 'DOC_QREL_DIR', 'ABS_QREL_DIR', 'CORPORA_DIR',
+                 'TRECTEXT_DIR', 'MANIFEST_DIR', 'PACKED_DIR', 'REPORT_DIR', 'ABSTRACT_STORE_FILE', 'TITLE_DIR',
+                 'FAILURE_QUEUE_FILE', 'INDEX_DIR', 'RUN_DIR', 'RUN_CACHE_DIR']:
+        setattr(tdc, name, os.path.join(tmp_dir, os.path.basename(getattr(tdc, name))))
+    tdc.BASE_DIR = tmp_dir  # relevance index, caches and manifest keys
+    tdc.check_existing()
+    return
+
+
+def _run_extract(args):
+    tmp_dir, topics, workers = args
+    use_tmp_dirs(tmp_dir)
+    tdc.PIDS_DIR = os.path.join(tmp_dir, 'pids_{}'.format(workers))
+    os.makedirs(tdc.PIDS_DIR)
+    tdc.RESUME = False
+    tdc.read_ovid_search_file = lambda: dict((topic_id, {'date': '19950101 - 20150101'}) for topic_id in topics)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        start_time = time.time()
+        tdc.extract_pid(workers=workers)
+        elapsed = time.time() - start_time
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return elapsed, peak_rss_mb()
+
+
+def bench_extract(num, workers, topic_num=4):
+    """
+    Time serial and parallel extract_pid over synthetic Ovid exports, each in a fresh process
+    :param num: int, record num per topic
+    :param workers: int, processes of the parallel run
+    :param topic_num: int
+    :return:
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        use_tmp_dirs(tmp_dir)
+        topics = [str(i) for i in range(topic_num)]
+        for topic_id in topics:
+            make_ovid_topic(tdc.DOWNLOAD_PIDS_DIR, topic_id, num, seed=int(topic_id) * 1000)
+        print('synthetic Ovid exports: {} topics x {} records, {} cpus'.format(
+            topic_num, num, multiprocessing.cpu_count()))
+
+        results = {}
+        for n in [1, workers]:
+            elapsed, rss = run_in_process(_run_extract, (tmp_dir, topics, n))
+            results[n] = elapsed
+            print('extract_pid(workers={}) | {:>8.2f} s | {:>10.1f} records/sec | peak RSS {:>8.1f} MB'.format(
+                n, elapsed, num * topic_num / elapsed, rss))
+
+        identical = True
+        for topic_id in topics:
+            with open(os.path.join(tmp_dir, 'pids_1', topic_id), 'rb') as f1, \
+                    open(os.path.join(tmp_dir, 'pids_{}'.format(workers), topic_id), 'rb') as f2:
+                identical = identical and f1.read() == f2.read()
+        print('speedup: {:.2f}x, identical output: {}'.format(results[1] / results[workers], identical))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return
+
+
+class FakeDriver(object):
+    """
+    Stand-in for webdriver.Chrome with a slow startup. Crashes on jobs listed in crash_jobs once.
+    """
+    startup_time = 1.0  # second
+    crash_jobs = set()
+    lock = threading.Lock()
+
+    def __init__(self):
+        time.sleep(self.startup_time)
+
+    def get(self, url):
+        with self.lock:
+            if url in self.crash_jobs:
+                self.crash_jobs.discard(url)
+                raise RuntimeError('chrome not reachable')
+        time.sleep(0.1)
+
+    def quit(self):
+        pass
+
+
+def bench_driver_pool(num, size, startup_time):
+    """
+    Compare starting a fresh browser for every topic with a DriverPool of reused sessions
+    :param num: int, topic num
+    :param size: int, pool size
+    :param startup_time: float, fake browser startup in seconds
+    :return:
+    """
+    FakeDriver.startup_time = startup_time
+    jobs = ['topic-{}'.format(i) for i in range(num)]
+
+    start_time = time.time()
+    for job in jobs:
+        driver = FakeDriver()
+        driver.get(job)
+        driver.quit()
+    fresh_time = time.time() - start_time
+    print('fresh browser per topic | {:>8.2f} s'.format(fresh_time))
+
+    FakeDriver.crash_jobs = set(jobs[::7])
+    pool = tdc.DriverPool(size=size, driver_factory=FakeDriver)
+    start_time = time.time()
+    try:
+        results = pool.map(lambda driver, job: driver.get(job) or job, jobs)
+    finally:
+        pool.close()
+    pool_time = time.time() - start_time
+    print('DriverPool({})           | {:>8.2f} s | {} crashed sessions recycled, {} jobs done'.format(
+        size, pool_time, len(jobs[::7]), sum(1 for r in results if r is not None)))
+    print('speedup: {:.2f}x'.format(fresh_time / pool_time))
+    return
+
+
+def make_reviews(topics):
+    """
+    Synthetic rows of medline_ovid_search.xlsx, as returned by read_ovid_search_file
+    :param topics: list of str, topic ids
+    :return: dict
+    """
+    return dict((topic_id, {'review_doi': 'CD{:06d}'.format(int(topic_id)),
+                            'url': 'http://onlinelibrary.wiley.com/doi/10.1002/14651858.CD{:06d}.pub2/full'.format(
+                                int(topic_id)),
+                            'query': '1. exp Randomized Controlled Trial/\n2. {} .ti,ab.\n3. 1 and 2'.format(topic_id),
+                            'date': '19950101 - 20150101'}) for topic_id in topics)
+
+
+def make_fixtures(scenario, tmp_dir, topic_num, num):
+    """
+    Write the inputs of a suite scenario to tmp_dir
+    :param scenario: str
+    :param tmp_dir: str
+    :param topic_num: int
+    :param num: int, records, pids or articles per topic
+    :return: int, number of operations the scenario does: records, pids, rows or documents
+    """
+    use_tmp_dirs(tmp_dir)
+    topics = [str(i + 1) for i in range(topic_num)]
+    dict_review = make_reviews(topics)
+    with open(os.path.join(tmp_dir, 'reviews.json'), 'w') as f:
+        json.dump(dict_review, f)
+    with codecs.open(tdc.TITLE_DIR, 'w', 'utf-8') as f:
+        for topic_id in topics:
+            f.write(u'{} ||| {} \n'.format(topic_id, random_text(random.Random(topic_id), 10)))
+
+    if 'extract_pid' == scenario:
+        for topic_id in topics:
+            make_ovid_topic(tdc.DOWNLOAD_PIDS_DIR, topic_id, num, seed=int(topic_id) * 1000)
+        return topic_num * num
+
+    if scenario in ('trec_format_abstract', 'build_index'):
+        for topic_id in topics:
+            os.makedirs(os.path.join(tdc.CORPORA_DIR, topic_id))
+            for block, first in enumerate(range(0, num, tdc.EFETCH_NUM_PER_TIME)):
+                make_pubmed_article_set(os.path.join(tdc.CORPORA_DIR, topic_id, str(block)),
+                                        min(tdc.EFETCH_NUM_PER_TIME, num - first), seed=int(topic_id) * 1000 + block,
+                                        first=int(topic_id) * 1000000 + first)
+        if 'build_index' == scenario:
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                tdc.trec_format_abstract()
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        return topic_num * num
+
+    # pids files with overlapping topics, and the relevance judgements of their reviews
+    dict_pids = {}
+    for topic_id in topics:
+        make_pids_file(os.path.join(tdc.PIDS_DIR, topic_id), num, seed=int(topic_id),
+                       first=20000000 + int(topic_id) * num // 2)
+        with codecs.open(os.path.join(tdc.PIDS_DIR, topic_id), 'r', 'utf-8') as f:
+            dict_pids[dict_review[topic_id]['review_doi']] = tdc.unique_pids(line.strip() for line in f)
+    row_num = make_relevance_index(os.path.join(tmp_dir, tdc.RELEVANCE_INDEX_FILE), dict_pids)
+    pid_num = sum(len(pids) for pids in dict_pids.values())
+
+    if 'read_clef_rel' == scenario:
+        return 2 * row_num
+    if 'make_release_file' == scenario:
+        return 3 * pid_num
+    if 'statistics' == scenario:
+        tdc.read_ovid_search_file = lambda: dict_review
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            tdc.make_release_files()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return pid_num
+    if scenario in ('download_abstract', 'download_format', 'stream_abstracts'):
+        return len(set(pid for pids in dict_pids.values() for pid in pids))
+    raise ValueError('unknown scenario {}'.format(scenario))
+
+
+def run_scenario(scenario, url):
+    """
+    The timed part of a suite scenario, on the fixtures of make_fixtures
+    :param scenario: str
+    :param url: str, stub efetch server of the download scenarios
+    :return:
+    """
+    if 'extract_pid' == scenario:
+        tdc.extract_pid()
+    elif 'trec_format_abstract' == scenario:
+        tdc.trec_format_abstract()
+    elif 'build_index' == scenario:
+        tdc.build_index()
+        tdc.bm25_run()
+    elif 'read_clef_rel' == scenario:
+        tdc.read_clef_rel('abs')
+        tdc.read_clef_rel('doc')
+    elif 'make_release_file' == scenario:
+        for qrel_type in ['topic', 'abs', 'doc']:
+            tdc.make_release_file(qrel_type)
+    elif 'statistics' == scenario:
+        tdc.statistics(extended=True)
+    elif 'download_abstract' == scenario:
+        tdc.NCBI_REQUESTS_PER_SECOND = 1000000  # the stub has no quota
+        tdc.download_abstract(api_url=url, api_key=None)
+    elif 'download_format' == scenario:
+        tdc.NCBI_REQUESTS_PER_SECOND = 1000000
+        tdc.download_abstract(api_url=url, api_key=None)
+        tdc.trec_format_abstract()
+    elif 'stream_abstracts' == scenario:
+        tdc.NCBI_REQUESTS_PER_SECOND = 1000000
+        tdc.stream_abstracts(api_url=url, api_key=None)
+    return
+
+
+def _make_fixtures(args):
+    return make_fixtures(*args)
+
+
+def _run_scenario(args):
+    scenario, tmp_dir, url = args
+    use_tmp_dirs(tmp_dir)
+    tdc.RESUME = False
+    with open(os.path.join(tmp_dir, 'reviews.json')) as f:
+        dict_review = json.load(f)
+    tdc.read_ovid_search_file = lambda: dict_review
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        start_time = time.time()
+        run_scenario(scenario, url)
+        elapsed = time.time() - start_time
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return elapsed, peak_rss_mb()
+
+
+SUITE_SCENARIOS = ['extract_pid', 'trec_format_abstract', 'build_index', 'read_clef_rel', 'make_release_file', 'statistics',
+                   'download_abstract', 'download_format', 'stream_abstracts']
+
+# default records, pids or articles per topic of each scenario, sized so that a run takes about a second or more
+SUITE_NUM = {'extract_pid': 12000, 'trec_format_abstract': 6000, 'build_index': 2000, 'read_clef_rel': 400000,
+             'make_release_file': 100000, 'statistics': 200000, 'download_abstract': 2500, 'download_format': 2000,
+             'stream_abstracts': 2000}
+SUITE_REPEAT = 5  # runs of each scenario, the fastest is reported
+SUITE_TOLERANCE = 0.3  # slowdown of ops/sec that fails the suite, above the drift of a shared host between runs
+
+
+def bench_suite(scenarios, topic_num, num, baseline_path, save_baseline=False, tolerance=SUITE_TOLERANCE,
+                repeat=SUITE_REPEAT):
+    """
+    Time the pipeline stages on synthetic fixtures and compare them with a baseline.
+    Every scenario runs repeat times, each in a fresh process on a fresh copy of its fixtures, and the fastest run
+    is reported. The runs go round robin over the scenarios, so that a slow spell of the machine does not take
+    all the runs of one scenario, and a scenario slower than the baseline runs repeat more times before it is
+    reported as a regression.
+    :param scenarios: list of str, see SUITE_SCENARIOS
+    :param topic_num: int
+    :param num: int, records, pids or articles per topic. None takes SUITE_NUM of each scenario.
+    :param baseline_path: str, json results of an earlier run
+    :param save_baseline: bool, store the results as the new baseline
+    :param tolerance: float, slowdown of ops/sec reported as a regression
+    :param repeat: int, runs of each scenario
+    :return: bool, whether no scenario regressed
+    """
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    python = '.'.join(sys.version.split()[0].split('.')[:2])
+    if baseline and not baseline.get('python', '').startswith(python + '.'):
+        print('baseline {} was measured with python {}, not compared'.format(baseline_path, baseline.get('python')))
+        baseline = {}
+
+    server, url = start_stub_efetch_server()
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    regressed = []
+    try:
+        print('{} topics, best of {} runs, {} cpus'.format(topic_num, repeat, multiprocessing.cpu_count()))
+        # fixtures are made in their own processes too, since a forked run starts from the peak RSS of this one
+        dict_ops = {scenario: run_in_process(_make_fixtures, (scenario, os.path.join(tmp_dir, scenario), topic_num,
+                                                              num or SUITE_NUM[scenario])) for scenario in scenarios}
+        dict_runs = defaultdict(list)
+
+        def ratio_of(scenario):
+            stored = baseline.get('results', {}).get(scenario)
+            if stored is None or stored.get('scale', baseline.get('scale')) != [topic_num,
+                                                                                num or SUITE_NUM[scenario]]:
+                return None
+            elapsed = min(seconds for seconds, rss in dict_runs[scenario])
+            return dict_ops[scenario] / max(elapsed, 1e-6) / stored['ops_per_sec']
+
+        pending = list(scenarios)
+        for rerun in [False, True]:
+            for i in range(repeat):
+                for scenario in pending:
+                    run_dir = os.path.join(tmp_dir, '{}_{}'.format(scenario, i))
+                    shutil.copytree(os.path.join(tmp_dir, scenario), run_dir)
+                    dict_runs[scenario].append(run_in_process(_run_scenario, (scenario, run_dir, url)))
+                    shutil.rmtree(run_dir)
+            pending = [scenario for scenario in pending if (ratio_of(scenario) or 1) < 1 - tolerance]
+            if not pending or save_baseline or rerun:
+                break
+            print('rerun {} slower than the baseline'.format(', '.join(pending)))
+
+        print('{:<22} | {:>7} | {:>9} | {:>5} | {:>8} | {:>12} | {:>13} | {}'.format(
+            'scenario', 'num', 'ops', 'runs', 'seconds', 'ops/sec', 'peak RSS (MB)', 'vs baseline'))
+        for scenario in scenarios:
+            scale, ops, runs = [topic_num, num or SUITE_NUM[scenario]], dict_ops[scenario], dict_runs[scenario]
+            elapsed = min(seconds for seconds, rss in runs)
+            rss = max(rss for seconds, rss in runs)
+            results[scenario] = {'scale': scale, 'ops': ops, 'seconds': elapsed,
+                                 'ops_per_sec': ops / max(elapsed, 1e-6), 'peak_rss_mb': rss}
+
+            compared = ''
+            stored = baseline.get('results', {}).get(scenario)
+            ratio = ratio_of(scenario)
+            if stored is not None and ratio is None:
+                compared = 'baseline at another scale {}'.format(stored.get('scale', baseline.get('scale')))
+            elif ratio is not None:
+                compared = '{:.2f}x ops/sec, {:+.1f} MB'.format(ratio, rss - stored['peak_rss_mb'])
+                if ratio < 1 - tolerance:
+                    compared += ' REGRESSION'
+                    regressed.append(scenario)
+            print('{:<22} | {:>7} | {:>9} | {:>5} | {:>8.2f} | {:>12.1f} | {:>13.1f} | {}'.format(
+                scenario, scale[1], ops, len(runs), elapsed, results[scenario]['ops_per_sec'], rss, compared))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+    if save_baseline:
+        if baseline:
+            results = dict(baseline['results'], **results)
+        with open(baseline_path, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'time': time.time(), 'repeat': repeat,
+                       'results': results}, f, indent=1, sort_keys=True)
+        print('baseline saved to {}'.format(baseline_path))
+    if regressed:
+        print('regressed more than {:.0f}%: {}'.format(tolerance * 100, ', '.join(regressed)))
+    return not regressed
+
+
+
+def tar_metrics_loop(ranking, relevant, total, cutoffs, wss_levels):
+    """
+    Per (run, topic) reference of tdc.tar_metrics, kept for comparison
+    :param ranking: list of int, pmids in rank order
+    :param relevant: set of int
+    :param total: int, # total doc of the topic
+    :return: dict, metric name -> float. None without relevant documents.
+    """
+    if not relevant:
+        return None
+    seen = set()
+    ranks = []
+    for pmid in ranking:
+        if pmid in seen:
+            continue
+        seen.add(pmid)
+        if pmid in relevant:
+            ranks.append(len(seen))
+    found = list(ranks)
+    end = max(total, len(seen))
+    ranks += [end - i for i in range(len(relevant) - len(ranks))]
+    ranks.sort()
+
+    rel_num = float(len(relevant))
+    metrics = {}
+    for k in cutoffs:
+        metrics['recall@{}'.format(k)] = sum(1 for r in found if r <= k) / rel_num
+    for level in wss_levels:
+        read = ranks[max(int(math.ceil(level * rel_num - 1e-9)), 1) - 1]
+        metrics['wss@{:g}'.format(level)] = float(total - read) / total - (1 - level)
+    metrics['last_rel'] = ranks[-1]
+    metrics['ap'] = sum((j + 1.0) / r for j, r in enumerate(found)) / rel_num
+    metrics['norm_area'] = sum(max(total - r + 1, 0) for r in ranks) / (rel_num * total -
+                                                                         rel_num * (rel_num - 1) / 2)
+    return metrics
+
+
+def check_tar_metrics():
+    """
+    Compare tdc.tar_metrics with values worked out by hand, for a run that misses relevant documents:
+    a topic of pmids 1 to 20, 1, 5 and 7 relevant, ranked by a run of pmids 1 and 10.
+    Recall and AP count pmid 1 at rank 1 only. Last_rel, wss and norm_area count 5 and 7 as found
+    at ranks 19 and 20, the end of the 20 documents.
+    A second topic has an empty qrel file and is the last topic code, the run ranks pmid 3 for it; its
+    metrics are nan and the first topic keeps its values.
+    :return:
+    """
+    qrel_pmid = np.arange(1, 21, dtype=np.int64)
+    qrel_rel = np.isin(qrel_pmid, [1, 5, 7])
+    metrics = tdc.tar_metrics(np.array([0, 0, 1], dtype=np.int64), np.array([1, 10, 3], dtype=np.int64), 2, 2,
+                              np.zeros(20, dtype=np.int32), qrel_pmid, qrel_rel, (10, 100, 1000), (1.0, 0.95))
+    expected = {'recall@10': 1 / 3.0, 'recall@100': 1 / 3.0, 'recall@1000': 1 / 3.0, 'ap': 1 / 3.0,
+                'last_rel': 20, 'wss@1': 0.0, 'wss@0.95': -0.05, 'norm_area': (20 + 2 + 1) / 57.0}
+    for name, value in expected.items():
+        assert np.allclose(metrics[name], [value, np.nan], equal_nan=True), \
+            '{} is {}, expected {}'.format(name, metrics[name].tolist(), [value, np.nan])
+    return
+
+
+def make_run(path, dict_qrel, seed=0):
+    """
+    Write a synthetic TREC run: per topic a shuffled part of the qrel pmids, with repeats and unjudged pmids
+    :param path: str
+    :param dict_qrel: dict, review_doi -> list of pmids
+    :param seed: int
+    :return:
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for review_doi in sorted(dict_qrel.keys()):
+            pmids = list(dict_qrel[review_doi])
+            rng.shuffle(pmids)
+            pmids = pmids[:rng.randint(len(pmids) // 2, len(pmids))]
+            pmids += [rng.choice(pmids) for _ in range(3)] + [rng.randint(1, 1000) for _ in range(3)]
+            for rank, pmid in enumerate(pmids):
+                f.write('{} Q0 {} {} {:.4f} run{}\n'.format(review_doi, pmid, rank + 1, 1.0 / (rank + 1), seed))
+    return
+
+
+def bench_evaluate(run_num, topic_num, num):
+    """
+    Time evaluate_runs against the per-topic loop reference on synthetic qrels and runs, and compare the values
+    :param run_num: int
+    :param topic_num: int
+    :param num: int, pids per topic
+    :return:
+    """
+    check_tar_metrics()
+    print('hand-computed metrics of a run missing relevant documents: same values')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        make_fixtures('statistics', tmp_dir, topic_num, num)
+        table = tdc.load_qrel_table()
+        dict_qrel = {}
+        dict_relevant = {}
+        for code, review_doi in enumerate(table['review_dois'].tolist()):
+            rows = table['topic'] == code
+            dict_qrel[review_doi] = table['pmid'][rows].tolist()
+            dict_relevant[review_doi] = set(table['pmid'][rows & (table['abs'] > 0)].tolist())
+        paths = []
+        for i in range(run_num):
+            paths.append(os.path.join(tmp_dir, 'run_{}'.format(i)))
+            make_run(paths[-1], dict_qrel, seed=i)
+
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            start_time = time.time()
+            review_dois, results = tdc.evaluate_runs(paths)
+            vector_time = time.time() - start_time
+            start_time = time.time()
+            _, cached_results = tdc.evaluate_runs(paths)
+            cached_time = time.time() - start_time
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        start_time = time.time()
+        reference = []
+        for path in paths:
+            dict_ranking = {}
+            with open(path) as f:
+                for line in f:
+                    columns = line.split()
+                    dict_ranking.setdefault(columns[0], []).append(int(columns[2]))
+            reference.append([tar_metrics_loop(dict_ranking.get(review_doi, []), dict_relevant[review_doi],
+                                               len(dict_qrel[review_doi]), tdc.TAR_RECALL_CUTOFFS,
+                                               tdc.TAR_WSS_LEVELS) for review_doi in review_dois.tolist()])
+        loop_time = time.time() - start_time
+
+        identical = sorted(results.keys()) == sorted(cached_results.keys())
+        for name, values in results.items():
+            identical = identical and np.allclose(values, cached_results[name], equal_nan=True)
+            expected = np.array([[np.nan if metrics is None else metrics[name] for metrics in row]
+                                 for row in reference])
+            identical = identical and np.allclose(values, expected, equal_nan=True)
+        print('{} runs x {} topics x {} pids | loop {:>8.2f} s | vectorized {:>8.2f} s | speedup {:.1f}x | '
+              'cached runs {:>8.2f} s | speedup {:.1f}x | same values: {}'.format(
+                  run_num, topic_num, num, loop_time, vector_time, loop_time / max(vector_time, 1e-6), cached_time,
+                  loop_time / max(cached_time, 1e-6), identical))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Offline benchmarks for tar_data_collection.py')
+    arg_parser.add_argument('benchmark', choices=['trec_format', 'pids', 'driver_pool', 'extract', 'suite',
+                                                  'evaluate'])
+    arg_parser.add_argument('--num', type=int,
+                            help='synthetic article, topic or record num, default 20000. '
+                                 'The suite default is SUITE_NUM of each scenario.')
+    arg_parser.add_argument('--list-max', type=int, default=100000, help='largest pid num for the list dedup')
+    arg_parser.add_argument('--pool-size', type=int, default=4, help='browser sessions')
+    arg_parser.add_argument('--startup', type=float, default=1.0, help='fake browser startup in seconds')
+    arg_parser.add_argument('--workers', type=int, default=4, help='processes of parallel runs')
+    arg_parser.add_argument('--topics', type=int, default=4, help='synthetic topic num of the suite and evaluate')
+    arg_parser.add_argument('--runs', type=int, default=200, help='synthetic run num of evaluate')
+    arg_parser.add_argument('--scenario', action='append', choices=SUITE_SCENARIOS,
+                            help='suite scenario to run, may be repeated. Default runs all.')
+    arg_parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                               'benchmark_baseline.json'),
+                            help='suite results to compare with')
+    arg_parser.add_argument('--save-baseline', action='store_true', help='store the suite results as the baseline')
+    arg_parser.add_argument('--tolerance', type=float, default=SUITE_TOLERANCE,
+                            help='ops/sec slowdown that fails the suite')
+    arg_parser.add_argument('--repeat', type=int, default=SUITE_REPEAT,
+                            help='runs of each suite scenario, the fastest is reported')
+    args = arg_parser.parse_args()
+    if args.num is None and 'suite' != args.benchmark:
+        args.num = 20000
+
+    if 'trec_format' == args.benchmark:
+        bench_trec_format(args.num)
+    elif 'pids' == args.benchmark:
+        bench_pids([10000, 100000, 1000000], args.list_max)
+    elif 'driver_pool' == args.benchmark:
+        bench_driver_pool(args.num, args.pool_size, args.startup)
+    elif 'extract' == args.benchmark:
+        bench_extract(args.num, args.workers)
+    elif 'evaluate' == args.benchmark:
+        bench_evaluate(args.runs, args.topics, args.num)
+    elif 'suite' == args.benchmark:
+        if not bench_suite(args.scenario or SUITE_SCENARIOS, args.topics, args.num, args.baseline,
+                           args.save_baseline, args.tolerance, args.repeat):
+            sys.exit(1)
@@ -17,34 +17,81 @@ Functions
  extract_pid                  --- Extract pids from downloaded xml and rewrite to new dir
  batch_download_title         --- Download title for all the systematic reviews
  make_release_file            --- Make release files: topic file or qrel file
+ make_release_files           --- Make topic files and both qrel files in one pass
  download_abstract            --- Download abstract for all the pids
  trec_format_abstract         --- Make the downloaded abstracts TRECTEXT format
+ stream_abstracts             --- Download abstracts and make them TRECTEXT format in one streaming pass
+ pack_corpora                 --- Pack the TRECTEXT documents of each topic for random access by pmid
+ build_index                  --- Build the inverted index of every topic and of the global corpus
+ bm25_run                     --- Rank the documents of every topic with BM25 into a TREC run file
  statistics                   --- Statistics of the released data
+ evaluate_runs                --- Evaluate TREC run files against the qrels with TAR metrics
 
 """
 
 
 import os
+import sys
 import re
+import heapq
 import csv
 import math
+import random
+import zlib
+import gzip
 import time
+import json
 import codecs
-import datetime
-import requests
-import pandas as pd
-from operator import itemgetter
-from collections import defaultdict
-
-import xml.dom.minidom
+import shutil
+import pickle
+import hashlib
+import sqlite3
+import argparse
+import functools
+import importlib
+import threading
+import warnings
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, as_completed  # the process pool is imported by the parallel stages
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # python 2
+    from Queue import Queue, Empty, Full
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from io import BytesIO
 from time import sleep
-from openpyxl import load_workbook
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is imported on first use and then replaces the stand-in in the globals,
+    so that a stage only pays for the imports it needs. selenium and openpyxl are imported by the functions using them.
+    """
+
+    def __init__(self, name, alias):
+        """
+        :param name: str, module name
+        :param alias: str, global name of the stand-in
+        """
+        self.name = name
+        self.alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        if globals().get(self.alias) is self:
+            globals()[self.alias] = module
+        return getattr(module, attr)
+
+
+np = LazyModule('numpy', 'np')
+requests = LazyModule('requests', 'requests')
 
 
 # Directories
@@ -59,16 +106,88 @@ DOC_QREL_DIR = os.path.join(BASE_DIR, 'doc_qrel')
 ABS_QREL_DIR = os.path.join(BASE_DIR, 'abs_qrel')
 CORPORA_DIR = os.path.join(BASE_DIR, 'copora')
 TRECTEXT_DIR = os.path.join(BASE_DIR, 'trectext')
+ABSTRACT_STORE_FILE = os.path.join(BASE_DIR, 'abstract_store.sqlite')
+FAILURE_QUEUE_FILE = os.path.join(BASE_DIR, 'failure_queue.json')
+MANIFEST_DIR = os.path.join(BASE_DIR, 'manifest')
+REPORT_DIR = os.path.join(BASE_DIR, 'report')
+PACKED_DIR = os.path.join(BASE_DIR, 'packed')
+INDEX_DIR = os.path.join(BASE_DIR, 'index')
+RUN_DIR = os.path.join(BASE_DIR, 'run')
+RUN_CACHE_DIR = os.path.join(BASE_DIR, 'run_cache')
 
 OVID_URL = "http://demo.ovid.com/demo/ovidsptools/launcher.htm"
 NCBI_API_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
 OVID_SEARCH_FILE = 'medline_ovid_search.xlsx'
+OVID_SEARCH_CACHE_FILE = 'medline_ovid_search.pickle'
 RELEVANCE_INDEX_FILE = 'relevance_index.csv'
-
-DOWNLOAD_NUM_PER_TIME = 500  # document num
+RELEVANCE_INDEX_CACHE_FILE = 'relevance_index.pickle'
+QREL_TABLE_CACHE_FILE = 'qrel_table.npz'
+
+# relevance of the judged ref types per qrel type, other ref types are skipped
+QREL_RELEVANCE = {
+    'abs': {'included': 1, 'excluded': 1},
+    'doc': {'included': 1, 'excluded': 0},
+}
+
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY', '')
+NCBI_REQUESTS_PER_SECOND = 3  # NCBI quota without api key
+NCBI_REQUESTS_PER_SECOND_WITH_KEY = 10  # NCBI quota with api key
+
+DOWNLOAD_NUM_PER_TIME = 500  # document num, first Ovid export size, and the most Ovid allows
+DOWNLOAD_NUM_MIN = 50  # document num, smallest Ovid export size
+DOWNLOAD_TARGET_TIME = 60  # second, Ovid exports are shrunk above and grown below half of it
+EFETCH_NUM_PER_TIME = 500  # document num, first efetch batch size and corpus block size
+EFETCH_NUM_MIN = 50  # document num, smallest efetch batch
+EFETCH_NUM_MAX = 2000  # document num, largest efetch batch
+EFETCH_TARGET_TIME = 15  # second, efetch batches are shrunk above and grown below half of it
+EFETCH_TARGET_BYTES = 32 * 1024 * 1024  # efetch batches are shrunk above it
+EFETCH_MAX_IN_FLIGHT = 3  # concurrent efetch requests
+EFETCH_POST_THRESHOLD = 200  # document num, NCBI asks for POST above 200 ids
+EFETCH_TIMEOUT = 120  # second
+EFETCH_RETRIES = 5  # retries of a failed, throttled or truncated request
+EFETCH_INCOMPLETE_RETRIES = 1  # retries of a response missing more than EFETCH_INCOMPLETE_SHORTFALL of its ids
+EFETCH_INCOMPLETE_SHORTFALL = 0.1  # fraction of ids, fewer missing are taken as withdrawn or deleted pmids
+EFETCH_RETRY_STATUS = (429, 500, 502, 503, 504)
+EFETCH_NOT_RETURNED = 'not returned by efetch'
+RETRY_BACKOFF_BASE = 1.0  # second
+RETRY_BACKOFF_MAX = 60.0  # second
+RETRY_AFTER_MAX = 300.0  # second, longest Retry-After honoured
+ABSTRACT_REFRESH_TTL = None  # day, stored articles older than this are fetched again. None keeps them.
 IMPLICIT_WAIT_TIME = 60  # second
 EXPLICIT_WAIT_TIME = 120  # second
 EXPLICIT_WAIT_INTERVAL = 2  # second
+DOWNLOAD_CHUNK_TIMEOUT = 300  # second, wait for one export file
+DOWNLOAD_POLL_INTERVAL = 0.5  # second
+DOWNLOAD_PARTIAL_SUFFIXES = ('.crdownload', '.part', '.tmp')
+DRIVER_POOL_SIZE = 4  # browser sessions
+PACKED_MAGIC = b'TARPACK2'
+PACKED_INDEX_DTYPE = [('pmid', '<i8'), ('offset', '<u8'), ('length', '<u4')]  # the index columns, stored one by one
+CHROME_HEADLESS = True
+
+RESUME = True  # skip units completed by earlier runs, see StageManifest
+MANIFEST_SAVE_INTERVAL = 10  # second
+
+# compression of the files written by a stage: None, 'gzip' or 'zstd' (pip install zstandard)
+STAGE_COMPRESSION = {'download_pids': None, 'copora': None, 'trectext': None}
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+STREAM_QUEUE_SIZE = 4  # items waiting between two stages of stream_abstracts
+
+INDEX_GLOBAL = 'all'  # name of the index over the corpus of all topics
+INDEX_SEGMENT_POSTINGS = 1000000  # (term, document) pairs held in memory before a segment is written
+INDEX_LEXICON_DTYPE = [('df', '<u4'), ('offset', '<u8'), ('length', '<u4')]
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+TRECTEXT_DOC_RE = re.compile(r'<DOC>\n<DOCNO>(.*?)</DOCNO>\n<TITLE>(.*?)</TITLE>\n<TEXT>(.*?)</TEXT>\n</DOC>\n',
+                             re.DOTALL)
+BM25_K1 = 0.9
+BM25_B = 0.4
+
+TAR_RECALL_CUTOFFS = (10, 100, 1000)  # document num
+TAR_WSS_LEVELS = (1.0, 0.95)  # recall levels of work saved over sampling
+EVAL_BATCH_ROWS = 10000000  # run rows evaluated at once
+EVAL_PMID_BITS = 40  # low bits of a (group, pmid) key
 
 
 def check_existing():
@@ -76,7 +195,8 @@ def check_existing():
     Check existing of directories
     :return:
     """
-    for mdir in [DOWNLOAD_PIDS_DIR, PIDS_DIR, TOPIC_DIR, DOC_QREL_DIR, ABS_QREL_DIR, CORPORA_DIR, TRECTEXT_DIR]:
+    for mdir in [DOWNLOAD_PIDS_DIR, PIDS_DIR, TOPIC_DIR, DOC_QREL_DIR, ABS_QREL_DIR, CORPORA_DIR, TRECTEXT_DIR,
+                 MANIFEST_DIR]:
         if not os.path.exists(mdir):
             os.makedirs(mdir)
     return
@@ -135,6 +255,27 @@ def get_dirs(path):
     return list_dirs
 
 
+def replace_file(src, dst):
+    """
+    Move src to dst, replacing dst if it exists. os.rename fails on an existing dst on Windows.
+    :param src: str
+    :param dst: str
+    :return:
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    # python 2
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+    return
+
+
 def get_tag_text(root, tagname):
     """
     Get text by tagname
@@ -170,25 +311,26 @@ def get_tag_list(root, tagname):
     return lst
 
 
-def read_ovid_search_file():
+def parse_ovid_search_rows(rows):
     """
-    Read medline_ovid_search.xlsx made by Rene (medical expert).
+    Parse the rows of medline_ovid_search.xlsx. A row is a topic if it has a topic id in column A,
+    which makes the valid rows independent of the sheet length; other rows, e.g. notes below the table, are skipped.
+    :param rows: iterable of cell value lists, columns A-F, header row excluded
     :return: dict
     """
     dict_review = defaultdict(dict)
 
-    # Load *.xlsx file
-    wb = load_workbook(os.path.join(BASE_DIR, OVID_SEARCH_FILE))
-    sheet_ranges = wb['Sheet1']
-
-    for i in range(2, 53):  # Line 1-52 are valid lines
-        ori_query = sheet_ranges['D{}'.format(i)].value.strip()
+    for row in rows:
+        row = list(row) + [None] * (6 - len(row))
+        if row[0] is None or not str(row[0]).strip():
+            continue
+        ori_query = row[3].strip()
         list_ori_query = [line.strip() for line in ori_query.split('\n') if line.strip() != '']
 
         query = '\n'.join(list_ori_query)
-        date_limit = sheet_ranges['F{}'.format(i)].value
-        link = sheet_ranges['B{}'.format(i)].value
-        topic_id = int(sheet_ranges['A{}'.format(i)].value)
+        date_limit = row[5]
+        link = row[1]
+        topic_id = int(row[0])
 
         topic_id = str(topic_id)
         dict_review[topic_id]['review_doi'] = re.findall(r'CD\d+', link)[0].strip()
@@ -196,11 +338,119 @@ def read_ovid_search_file():
         dict_review[topic_id]['query'] = query.strip()
         dict_review[topic_id]['date'] = date_limit.strip()
 
-    print('dict_review keys length: {} \ndict_review keys: {} \n'.format(len(dict_review.keys()), dict_review.keys()))
+    return dict_review
+
+
+def read_pickle_cache(cache_path, key):
+    """
+    Read a pickle sidecar file written by write_pickle_cache
+    :param cache_path: str
+    :param key: picklable, e.g. the mtime or digest of the source file
+    :return: cached value, None if the file is missing, unreadable or written for another key
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            cache_key, value = pickle.load(f)
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    return value if cache_key == key else None
+
+
+def write_pickle_cache(cache_path, key, value):
+    """
+    Write a pickle sidecar file, replacing the previous one at once
+    :param cache_path: str
+    :param key: picklable, e.g. the mtime or digest of the source file
+    :param value: picklable
+    :return:
+    """
+    tmp_path = '{}.{}'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+    replace_file(tmp_path, cache_path)
+    return
+
+
+# search file -> (mtime, size, reviews)
+_OVID_SEARCH_CACHE = {}
 
+
+def read_ovid_search_file():
+    """
+    Read medline_ovid_search.xlsx made by Rene (medical expert), streamed with a read-only workbook.
+    The parsed reviews are cached in memory, invalidated by the xlsx mtime and size, and in a pickle sidecar file,
+    invalidated by the xlsx sha1, so every stage after the first one skips the workbook.
+    :return: dict
+    """
+    path = os.path.join(BASE_DIR, OVID_SEARCH_FILE)
+    cache_path = os.path.join(BASE_DIR, OVID_SEARCH_CACHE_FILE)
+    st = os.stat(path)
+
+    # in memory
+    cached = _OVID_SEARCH_CACHE.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+
+    # sidecar file
+    digest = file_digest(path)
+    dict_review = read_pickle_cache(cache_path, digest)
+
+    # xlsx
+    if dict_review is None:
+        from openpyxl import load_workbook
+
+        wb = load_workbook(path, read_only=True)
+        try:
+            rows = wb['Sheet1'].iter_rows(min_row=2, max_col=6)  # line 1 is the header
+            dict_review = parse_ovid_search_rows([cell.value for cell in row] for row in rows)
+        finally:
+            wb.close()
+        print('dict_review keys length: {} \ndict_review keys: {} \n'.format(len(dict_review.keys()),
+                                                                            dict_review.keys()))
+        write_pickle_cache(cache_path, digest, dict_review)
+
+    _OVID_SEARCH_CACHE[path] = (st.st_mtime, st.st_size, dict_review)
     return dict_review
 
 
+# relevance index file -> (mtime, index)
+_RELEVANCE_INDEX_CACHE = {}
+
+
+def load_relevance_index():
+    """
+    Load relevance judgement file made by Rene (medical expert) into one index
+    review_doi -> {pmid: 1 if included else 0}, holding only the judged rows.
+    The index is cached in memory and in a pickle sidecar file, both invalidated by the csv mtime.
+    :return: dict
+    """
+    path = os.path.join(BASE_DIR, RELEVANCE_INDEX_FILE)
+    cache_path = os.path.join(BASE_DIR, RELEVANCE_INDEX_CACHE_FILE)
+    mtime = os.path.getmtime(path)
+
+    # in memory
+    if path in _RELEVANCE_INDEX_CACHE and _RELEVANCE_INDEX_CACHE[path][0] == mtime:
+        return _RELEVANCE_INDEX_CACHE[path][1]
+
+    # sidecar file
+    index = read_pickle_cache(cache_path, mtime)
+
+    # csv
+    if index is None:
+        index = {}
+        with codecs.open(path, 'r', 'utf-8') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                if row['ref_type'] not in ('included', 'excluded'):
+                    continue
+                review_doi = re.findall(r'CD\d+', row['review_doi'])[0].strip()
+                index.setdefault(review_doi, {})[row['pubmed_id'].strip()] = int('included' == row['ref_type'])
+        write_pickle_cache(cache_path, mtime, index)
+
+    _RELEVANCE_INDEX_CACHE[path] = (mtime, index)
+    return index
+
+
 def read_clef_rel(qrel_type):
     """
     Read relevance judgement file made by Rene (medical expert).
@@ -208,31 +458,13 @@ def read_clef_rel(qrel_type):
     :return: dict
     """
     dict_rel = defaultdict(dict)
-    with codecs.open(os.path.join(BASE_DIR, RELEVANCE_INDEX_FILE), 'r', 'utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            review_doi = re.findall(r'CD\d+', row['review_doi'])[0].strip()
-            pubmed_id = row['pubmed_id'].strip()
-            # abs
-            if 'abs' == qrel_type:
-                if 'included' == row['ref_type']:
-                    ref_type = 1
-                elif 'excluded' == row['ref_type']:
-                    ref_type = 1
-                else:
-                    continue
+    if qrel_type not in QREL_RELEVANCE:
+        return dict_rel
 
-            # doc
-            elif 'doc' == qrel_type:
-                if 'included' == row['ref_type']:
-                    ref_type = 1
-                elif 'excluded' == row['ref_type']:
-                    ref_type = 0
-                else:
-                    continue
-            else:
-                break
-            dict_rel[review_doi][pubmed_id] = ref_type
+    rel_included, rel_excluded = QREL_RELEVANCE[qrel_type]['included'], QREL_RELEVANCE[qrel_type]['excluded']
+    for review_doi, judgements in load_relevance_index().items():
+        dict_rel[review_doi] = dict((pmid, rel_included if included else rel_excluded)
+                                    for pmid, included in judgements.items())
     return dict_rel
 
 
@@ -248,18 +480,747 @@ def record_log(topic_id, search_query, err_msg):
         f.write('{}\n\n\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))))
 
         f.write('topic id: {} \n\n'.format(topic_id))
-        f.write('search query:\n {} \n\n'.decode('utf-8').format(search_query))
-        f.write('error msg: \n {} \n\n'.decode('utf-8').format(err_msg))
+        f.write(u'search query:\n {} \n\n'.format(search_query))
+        f.write(u'error msg: \n {} \n\n'.format(err_msg))
+
+    update_failure_queue(add=[{'kind': 'ovid', 'key': str(topic_id), 'error': err_msg,
+                               'payload': {'query': search_query}}])
+    return
+
+
+# guards the read-modify-write of FAILURE_QUEUE_FILE
+_FAILURE_QUEUE_LOCK = threading.Lock()
+
+
+def read_failure_queue(kind=None):
+    """
+    Read the persistent failure queue: units that failed after all retries, to be drained by a later run
+    :param kind: str, 'efetch' (key is a pmid), 'ovid' or 'title' (key is a topic id). Default is all.
+    :return: dict, key -> entry with kind, key, error, payload, attempts, first_failed and last_failed
+    """
+    try:
+        with codecs.open(FAILURE_QUEUE_FILE, 'r', 'utf-8') as f:
+            queue = json.load(f)
+    except (IOError, OSError, ValueError):
+        queue = {}
+    return dict((entry['key'], entry) for entry in queue.values() if kind is None or entry['kind'] == kind)
+
+
+def update_failure_queue(add=(), remove=()):
+    """
+    Add failed units to and remove recovered units from the failure queue
+    :param add: list of dict, with kind, key, error and an optional json payload
+    :param remove: list of (kind, key)
+    :return:
+    """
+    add, remove = list(add), list(remove)
+    if not add and not remove:
+        return
+    with _FAILURE_QUEUE_LOCK:
+        try:
+            with codecs.open(FAILURE_QUEUE_FILE, 'r', 'utf-8') as f:
+                queue = json.load(f)
+        except (IOError, OSError, ValueError):
+            queue = {}
+
+        size = len(queue)
+        for kind, key in remove:
+            queue.pop('{}/{}'.format(kind, key), None)
+        if not add and size == len(queue):
+            return
+
+        now = time.time()
+        for failure in add:
+            entry = queue.setdefault('{}/{}'.format(failure['kind'], failure['key']),
+                                     {'kind': failure['kind'], 'key': failure['key'], 'attempts': 0,
+                                      'first_failed': now})
+            entry.update(error=failure['error'], payload=failure.get('payload'), last_failed=now,
+                         attempts=entry['attempts'] + 1)
+
+        tmp_path = '{}.{}'.format(FAILURE_QUEUE_FILE, os.getpid())
+        with codecs.open(tmp_path, 'w', 'utf-8') as f:
+            json.dump(queue, f, indent=1, sort_keys=True)
+        replace_file(tmp_path, FAILURE_QUEUE_FILE)
+    return
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Delay before a retry: the server's Retry-After if it sent one, otherwise exponential backoff
+    with full jitter, so that concurrent clients do not retry in step
+    :param attempt: int, 0 for the first retry
+    :param retry_after: float, second
+    :return: float, second
+    """
+    if retry_after is not None:
+        return min(retry_after, RETRY_AFTER_MAX) + random.uniform(0, RETRY_BACKOFF_BASE)
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """
+    :param value: str, Retry-After header, seconds or an HTTP date
+    :return: float, second. None if absent or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_tz, mktime_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+def compressed_path(path, codec):
+    """
+    :param path: str, file path without compression suffix
+    :param codec: str, None, 'gzip' or 'zstd'
+    :return: str, path with the suffix of the codec
+    """
+    return path + COMPRESSION_SUFFIXES[codec] if codec else path
+
+
+def strip_compression(name):
+    """
+    :param name: str, file name or path
+    :return: str, name without compression suffix
+    """
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def open_compressed(path, mode='rb'):
+    """
+    Open a file as a binary stream, compressed or not by the suffix of its name: .gz, .zst or none
+    :param path: str
+    :param mode: str, 'rb' or 'wb'
+    :return: file object
+    """
+    if path.endswith(COMPRESSION_SUFFIXES['gzip']):
+        return gzip.open(path, mode, GZIP_LEVEL)
+    if path.endswith(COMPRESSION_SUFFIXES['zstd']):
+        import zstandard  # optional, pip install zstandard
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, 'wb'))
+    return open(path, mode)
+
+
+def open_compressed_text(path, mode='r'):
+    """
+    Open a file as utf-8 text, compressed or not by the suffix of its name, like codecs.open
+    :param path: str
+    :param mode: str, 'r' or 'w'
+    :return: file object
+    """
+    if 'r' in mode:
+        return codecs.getreader('utf-8')(open_compressed(path, 'rb'))
+    return codecs.getwriter('utf-8')(open_compressed(path, 'wb'))
+
+
+def compress_file(path, codec):
+    """
+    Replace a file by its compressed copy
+    :param path: str
+    :param codec: str, 'gzip' or 'zstd'
+    :return: str, path of the compressed file
+    """
+    dst = compressed_path(path, codec)
+    with open(path, 'rb') as fr, open_compressed(dst, 'wb') as fw:
+        shutil.copyfileobj(fr, fw, 1024 * 1024)
+    os.remove(path)
+    return dst
+
+
+def remove_other_variants(path):
+    """
+    Remove the copies of a file with another compression, left by runs with another setting
+    :param path: str
+    :return:
+    """
+    plain = strip_compression(path)
+    for variant in [plain] + [plain + suffix for suffix in COMPRESSION_SUFFIXES.values()]:
+        if variant != path and os.path.exists(variant):
+            os.remove(variant)
+    return
+
+
+def file_digest(path):
+    """
+    sha1 of a file
+    :param path:
+    :return: str
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class Span(object):
+    """
+    One timed unit of work: a stage, a topic, a block, a request.
+    """
+
+    def __init__(self, name, stage=None, attrs=None):
+        """
+        :param name: str, kind of unit, e.g. 'efetch'
+        :param stage: str, the stage it runs in
+        :param attrs: dict, e.g. topic and block
+        """
+        self.name = name
+        self.stage = stage
+        self.attrs = attrs or {}
+        self.start = time.time()
+        self.wall = 0.0
+        self.bytes = 0
+        self.records = 0
+        self.retries = 0
+
+    def add(self, bytes=0, records=0, retries=0):
+        """
+        Count work done in the span
+        :param bytes: int, bytes read or written
+        :param records: int, e.g. documents or pids
+        :param retries: int
+        :return:
+        """
+        self.bytes += bytes
+        self.records += records
+        self.retries += retries
+        return
+
+    def as_dict(self):
+        return dict(self.attrs, name=self.name, stage=self.stage, start=self.start, wall=self.wall,
+                    bytes=self.bytes, records=self.records, retries=self.retries)
+
+
+class RunReport(object):
+    """
+    Spans of a pipeline run, written as a JSON and a CSV report by write.
+    Units of worker processes are timed in the worker and recorded by the parent with record.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.stage = None
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, stage=False, **attrs):
+        """
+        Time the body of a with statement
+        :param name: str
+        :param stage: bool, the span is a pipeline stage, which the spans in its body are grouped under
+        :param attrs: json values, e.g. topic='CD007394'
+        :return: Span, to count bytes, records and retries
+        """
+        outer_stage = self.stage
+        if stage:
+            self.stage = name
+        span = Span(name, self.stage, attrs)
+        try:
+            yield span
+        except Exception as e:
+            span.attrs['error'] = repr(e)
+            raise
+        finally:
+            span.wall = time.time() - span.start
+            self.stage = outer_stage
+            with self.lock:
+                self.spans.append(span)
+
+    def record(self, name, wall, bytes=0, records=0, retries=0, **attrs):
+        """
+        Add a span timed elsewhere, e.g. in a worker process
+        :param name: str
+        :param wall: float, second
+        :return:
+        """
+        span = Span(name, self.stage, attrs)
+        span.start -= wall
+        span.wall = wall
+        span.add(bytes, records, retries)
+        with self.lock:
+            self.spans.append(span)
+        return
+
+    def summary(self):
+        """
+        Totals per (stage, span name)
+        :return: list of dict, in order of first appearance
+        """
+        dict_total = {}
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        for span in spans:
+            key = (span.stage, span.name)
+            if key not in dict_total:
+                dict_total[key] = {'stage': span.stage, 'name': span.name, 'count': 0, 'wall': 0.0, 'bytes': 0,
+                                   'records': 0, 'retries': 0, 'errors': 0, 'order': len(dict_total)}
+            total = dict_total[key]
+            total['count'] += 1
+            total['wall'] += span.wall
+            total['bytes'] += span.bytes
+            total['records'] += span.records
+            total['retries'] += span.retries
+            total['errors'] += int('error' in span.attrs)
+
+        list_total = sorted(dict_total.values(), key=lambda total: total.pop('order'))
+        for total in list_total:
+            total['records_per_sec'] = total['records'] / max(total['wall'], 1e-6)
+        return list_total
+
+    def write(self, report_dir=None):
+        """
+        Write report_dir/run_<time>.json, with the totals and every span, and
+        report_dir/run_<time>.csv, with every span
+        :param report_dir: str, default is REPORT_DIR
+        :return: str, path of the json report
+        """
+        report_dir = report_dir or REPORT_DIR
+        if not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+        path = os.path.join(report_dir, 'run_{}'.format(time.strftime('%Y%m%d_%H%M%S',
+                                                                        time.localtime(self.start_time))))
+        with self.lock:
+            spans = [span.as_dict() for span in sorted(self.spans, key=lambda span: span.start)]
+
+        with codecs.open('{}.json'.format(path), 'w', 'utf-8') as f:
+            json.dump({'start': self.start_time, 'wall': time.time() - self.start_time, 'summary': self.summary(),
+                       'spans': spans}, f, indent=1, sort_keys=True)
+
+        columns = ['stage', 'name', 'start', 'wall', 'bytes', 'records', 'retries']
+        columns += sorted(set(key for span in spans for key in span) - set(columns))
+        with open('{}.csv'.format(path), 'w') as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writerow(dict(zip(columns, columns)))
+            for span in spans:
+                writer.writerow(dict((key, value.encode('utf-8') if isinstance(value, type(u'')) and str is bytes
+                                      else value) for key, value in span.items()))
+        return '{}.json'.format(path)
+
+
+RUN_REPORT = RunReport()
+
+
+def timed_stage(func):
+    """
+    Run a pipeline stage inside a stage span of RUN_REPORT
+    :param func: stage function
+    :return: wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with RUN_REPORT.span(func.__name__, stage=True):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def run_profiled(func, profiler, path):
+    """
+    Run func under a profiler and write its output
+    :param func: callable without arguments
+    :param profiler: str, 'cprofile' writes pstats data, 'pyinstrument' writes an html page
+    :param path: str, output file without extension
+    :return: result of func
+    """
+    if 'pyinstrument' == profiler:
+        from pyinstrument import Profiler  # optional, pip install pyinstrument
+        prof = Profiler()
+        prof.start()
+        try:
+            return func()
+        finally:
+            prof.stop()
+            with codecs.open('{}.html'.format(path), 'w', 'utf-8') as f:
+                f.write(prof.output_html())
+
+    import cProfile
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func)
+    finally:
+        prof.dump_stats('{}.prof'.format(path))
+
+
+class StageManifest(object):
+    """
+    Checkpoint manifest of one pipeline stage, saved to MANIFEST_DIR/<stage>.json.
+    Every unit of the stage, e.g. a topic or a (topic, block) file, records the hashes of its input files,
+    its parameters, the hashes of its output files and its status. A unit is done when its last run
+    succeeded and neither its inputs, its parameters nor its outputs changed since.
+    Files are re-hashed only when their size or mtime changed.
+    """
+
+    def __init__(self, stage):
+        """
+        :param stage: str, e.g. 'extract'
+        """
+        self.path = os.path.join(MANIFEST_DIR, '{}.json'.format(stage))
+        self.units = {}
+        self.digests = {}  # path -> [size, mtime, sha1]
+        if os.path.exists(self.path):
+            with codecs.open(self.path, 'r', 'utf-8') as f:
+                data = json.load(f)
+            self.units = data['units']
+            self.digests = data['digests']
+        self.lock = threading.RLock()
+        self.save_time = time.time()
+
+    def digest(self, path):
+        """
+        :param path:
+        :return: str, sha1 of the file. None if it does not exist.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.relpath(path, BASE_DIR)
+        cached = self.digests.get(key)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        sha1 = file_digest(path)
+        self.digests[key] = [st.st_size, st.st_mtime, sha1]
+        return sha1
+
+    def fingerprint(self, paths):
+        """
+        :param paths: list of file paths
+        :return: dict, relative path -> sha1
+        """
+        return dict((os.path.relpath(path, BASE_DIR), self.digest(path)) for path in paths)
+
+    def is_done(self, unit, inputs=(), params=None):
+        """
+        Whether a unit can be skipped
+        :param unit: str
+        :param inputs: list of input file paths
+        :param params: dict of json values the outputs depend on
+        :return: bool
+        """
+        if not RESUME:
+            return False
+        with self.lock:
+            entry = self.units.get(unit)
+            if entry is None or 'done' != entry['status'] or entry['params'] != (params or {}):
+                return False
+            if entry['inputs'] != self.fingerprint(inputs):
+                return False
+            return all(self.digest(os.path.join(BASE_DIR, path)) == sha1 for path, sha1 in entry['outputs'].items())
+
+    def result(self, unit):
+        """
+        :param unit: str
+        :return: result recorded by mark_done
+        """
+        return self.units[unit].get('result')
+
+    def mark_done(self, unit, inputs=(), outputs=(), params=None, result=None):
+        """
+        Record a completed unit
+        :param unit: str
+        :param inputs: list of input file paths
+        :param outputs: list of output file paths
+        :param params: dict of json values the outputs depend on
+        :param result: json value to keep, e.g. a downloaded title
+        :return:
+        """
+        with self.lock:
+            self.units[unit] = {'status': 'done', 'time': time.time(), 'params': params or {},
+                                'inputs': self.fingerprint(inputs), 'outputs': self.fingerprint(outputs),
+                                'result': result}
+            if time.time() - self.save_time > MANIFEST_SAVE_INTERVAL:
+                self.save()
+        return
+
+    def mark_failed(self, unit, error, params=None):
+        """
+        Record a failed unit
+        :param unit: str
+        :param error: str
+        :param params: dict
+        :return:
+        """
+        with self.lock:
+            self.units[unit] = {'status': 'failed', 'time': time.time(), 'params': params or {}, 'error': str(error)}
+            self.save()
+        return
+
+    def save(self):
+        """
+        Write the manifest file
+        :return:
+        """
+        with self.lock:
+            if not os.path.exists(MANIFEST_DIR):
+                os.makedirs(MANIFEST_DIR)
+            tmp_path = '{}.{}'.format(self.path, os.getpid())
+            with codecs.open(tmp_path, 'w', 'utf-8') as f:
+                json.dump({'units': self.units, 'digests': self.digests}, f, indent=1, sort_keys=True)
+            replace_file(tmp_path, self.path)
+            self.save_time = time.time()
+        return
+
+
+@contextmanager
+def run_tasks(func, tasks, workers=1, ordered=True, manifest=None):
+    """
+    Run func over the tasks of a parallel stage, in worker processes if workers > 1
+    :param func: picklable function of one task
+    :param tasks: list
+    :param workers: int, processes
+    :param ordered: bool, yield results in task order, else as they finish
+    :param manifest: StageManifest, saved when the stage is done with the results, also after an error
+    :return: iterator of results
+    """
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        if ordered:
+            results = executor.map(func, tasks)
+        else:
+            results = (future.result() for future in as_completed([executor.submit(func, task) for task in tasks]))
+    else:
+        executor = None
+        results = (func(task) for task in tasks)
+
+    try:
+        yield results
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if manifest is not None:
+            manifest.save()
+
+
+def make_chrome_driver(download_dir=None):
+    """
+    Start a Chrome session
+    :param download_dir: str, directory for downloaded files
+    :return: webdriver.Chrome
+    """
+    from selenium import webdriver
+
+    # chrome settings
+    chromeptions = webdriver.ChromeOptions()
+    if CHROME_HEADLESS:
+        chromeptions.add_argument('--headless')
+    prefs = {'profile.default_content_settings.popups': 0}
+    if download_dir is not None:
+        prefs['download.default_directory'] = download_dir
+    chromeptions.add_experimental_option('prefs', prefs)
+
+    # start chrome browser
+    chromedriver = CHROMEDRIVER_DIR
+    os.environ["webdriver.chrome.driver"] = chromedriver
+    driver = webdriver.Chrome(executable_path=chromedriver, chrome_options=chromeptions)
+
+    if download_dir is not None:
+        set_chrome_download_dir(driver, download_dir)  # headless chrome ignores the prefs
+    return driver
+
+
+def set_chrome_download_dir(driver, download_dir):
+    """
+    Point the downloads of a running Chrome session to another directory
+    :param driver: webdriver.Chrome
+    :param download_dir: str
+    :return:
+    """
+    driver.command_executor._commands['send_command'] = ('POST', '/session/$sessionId/chromium/send_command')
+    driver.execute('send_command', {'cmd': 'Page.setDownloadBehavior',
+                                    'params': {'behavior': 'allow', 'downloadPath': download_dir}})
+    return
+
+
+def close_other_windows(driver, window_handle):
+    """
+    Close all windows but one, so that a reused session starts clean
+    :param driver:
+    :param window_handle: handle of the window to keep
+    :return:
+    """
+    for hdl in driver.window_handles:
+        if hdl != window_handle:
+            driver.switch_to.window(hdl)
+            driver.close()
+    driver.switch_to.window(window_handle)
     return
 
 
-def download_pid_by_topic_id(topic_id, str_search_query):
+def list_downloaded_files(download_dir):
+    """
+    Get the completely downloaded files in a directory
+    :param download_dir:
+    :return: set
+    """
+    return set(f for f in os.listdir(download_dir)
+               if not f.startswith('.') and not f.endswith(DOWNLOAD_PARTIAL_SUFFIXES))
+
+
+def wait_for_downloads(download_dir, known_files, expected_num, timeout):
+    """
+    Poll download_dir until expected_num new files are downloaded, no partial download is left
+    and the sizes of the new files did not change since the previous poll.
+    :param download_dir:
+    :param known_files: set, files downloaded before
+    :param expected_num: int, new files to wait for
+    :param timeout: second
+    :return: set, new files. Fewer than expected_num on timeout.
+    """
+    deadline = time.time() + timeout
+    last_sizes = None
+    while True:
+        files = os.listdir(download_dir)
+        partial = [f for f in files if f.endswith(DOWNLOAD_PARTIAL_SUFFIXES)]
+        new_files = list_downloaded_files(download_dir) - known_files
+
+        sizes = {}
+        for f in new_files:
+            try:
+                sizes[f] = os.path.getsize(os.path.join(download_dir, f))
+            except OSError:  # renamed meanwhile
+                sizes = None
+                break
+
+        if len(new_files) >= expected_num and not partial and sizes is not None and sizes == last_sizes:
+            return new_files
+        if time.time() > deadline:
+            return new_files
+
+        last_sizes = sizes
+        sleep(DOWNLOAD_POLL_INTERVAL)
+
+
+class DriverPool(object):
+    """
+    Pool of reusable browser sessions that jobs are scheduled onto.
+    Sessions are started lazily, at most one per worker thread. A session that fails to start, or whose job
+    raises, is quit and replaced by a fresh one, and the job is retried.
+    """
+
+    def __init__(self, size=DRIVER_POOL_SIZE, driver_factory=make_chrome_driver, retries=1, on_failure=None):
+        """
+        :param size: int, browser sessions
+        :param driver_factory: callable starting a session, e.g. a fake driver in benchmarks
+        :param retries: int, retries of a job on a fresh session
+        :param on_failure: callable(job, error) called when every attempt of a job failed, e.g. to record it
+        """
+        self.size = size
+        self.driver_factory = driver_factory
+        self.retries = retries
+        self.on_failure = on_failure
+        self.idle = Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Get an idle session, or start one
+        :return: driver
+        """
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            driver = self.driver_factory()
+            with self.lock:
+                self.drivers.append(driver)
+            return driver
+
+    def discard(self, driver):
+        """
+        Quit a crashed session
+        :param driver:
+        :return:
+        """
+        with self.lock:
+            self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        return
+
+    def run(self, func, job):
+        """
+        Run func(driver, job) on a session
+        :param func:
+        :param job:
+        :return: result of func, None if every attempt failed
+        """
+        with RUN_REPORT.span('browser_job', job=str(job)) as span:
+            for attempt in range(self.retries + 1):
+                driver = None
+                try:
+                    driver = self.acquire()  # a session failing to start is a crash like any other
+                    result = func(driver, job)
+                except Exception as e:
+                    print('browser session failed on {} (attempt {}): {}'.format(job, attempt + 1, e))
+                    error = e
+                    if driver is not None:
+                        self.discard(driver)
+                    if attempt < self.retries:
+                        span.add(retries=1)
+                        sleep(backoff_delay(attempt))
+                    continue
+                self.idle.put(driver)
+                return result
+            span.attrs['error'] = 'every attempt failed'
+        if self.on_failure is not None:
+            self.on_failure(job, error)
+        return None
+
+    def map(self, func, jobs):
+        """
+        Run func(driver, job) for all jobs, at most size at a time
+        :param func:
+        :param jobs: list
+        :return: list of results, in the order of jobs
+        """
+        executor = ThreadPoolExecutor(max_workers=self.size)
+        try:
+            return list(executor.map(lambda job: self.run(func, job), jobs))
+        finally:
+            executor.shutdown(wait=True)
+
+    def close(self):
+        """
+        Quit all sessions
+        :return:
+        """
+        with self.lock:
+            drivers, self.drivers = self.drivers, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+        return
+
+
+def download_pid_by_topic_id(topic_id, str_search_query, driver=None, sizer=None):
     """
     Download pids by topic id
     :param topic_id:
     :param str_search_query:
-    :return:
+    :param driver: browser session to reuse, e.g. from DriverPool. Default starts a new one.
+    :param sizer: BatchSizer of the export size, shared by the topics. Default starts a new one.
+    :return: bool, whether every export file is downloaded
     """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as ec
+    from selenium.common.exceptions import NoSuchElementException, TimeoutException
+
     print('processing systematic review {}'.format(topic_id))
 
     # remove all the blanks at the beginning of every line
@@ -270,17 +1231,15 @@ def download_pid_by_topic_id(topic_id, str_search_query):
     if not os.path.exists(topic_dir):  # make dir
         os.makedirs(topic_dir)
 
-    # chrome settings
-    chromeptions = webdriver.ChromeOptions()
-    prefs = {'profile.default_content_settings.popups': 0, 'download.default_directory': topic_dir}
-    chromeptions.add_experimental_option('prefs', prefs)
-
-    # start chrome browser
-    chromedriver = CHROMEDRIVER_DIR
-    os.environ["webdriver.chrome.driver"] = chromedriver
-    driver = webdriver.Chrome(executable_path=chromedriver, chrome_options=chromeptions)
+    # start chrome browser, or point the reused one to the topic directory
+    own_driver = driver is None
+    if own_driver:
+        driver = make_chrome_driver(topic_dir)
+    else:
+        set_chrome_download_dir(driver, topic_dir)
 
     # request and response of website
+    search_start = time.time()
     driver.get(OVID_URL)
 
     # set mesz
@@ -310,24 +1269,39 @@ def download_pid_by_topic_id(topic_id, str_search_query):
             # WARNING: must wait until webpage loading is finished, then get search_ret_num
             search_ret_num = WebDriverWait(driver, EXPLICIT_WAIT_TIME, EXPLICIT_WAIT_INTERVAL).until(
                 ec.presence_of_element_located((By.XPATH, '//*[@id="searchaid-numbers"]')))
-            search_ret_num = int(re.findall(r'\d+', search_ret_num.text.encode('utf-8'))[0])  #  Extract from str like "30963 text results"
+            search_ret_num = int(re.findall(r'\d+', search_ret_num.text)[0])  #  Extract from str like "30963 text results"
         except TimeoutException:
             record_log(topic_id=topic_id, search_query=str_search_query, err_msg='system timeout.')
-            return
+            RUN_REPORT.record('ovid_search', time.time() - search_start, topic=topic_id, error='system timeout')
+            return False
+        RUN_REPORT.record('ovid_search', time.time() - search_start, records=search_ret_num, topic=topic_id)
 
+        # the page is loaded now, so do not wait IMPLICIT_WAIT_TIME for an error that is not there
+        driver.implicitly_wait(0)
         try:
             #  grammatical error exists in search query, record error for medical expert to analyze
             error = driver.find_element_by_xpath('//*[@id="msp-error-easy"]')
             record_log(topic_id=topic_id, search_query=str_search_query, err_msg=error.text)
-            return
+            return False
         except NoSuchElementException:
             # if webpage loading timeout happens, just pass.
             pass
+        finally:
+            driver.implicitly_wait(IMPLICIT_WAIT_TIME)
+
+        # OVID system allows to download maximum 500 documents per time, fewer while exports are slow
+        if sizer is None:
+            sizer = BatchSizer('ovid_export', DOWNLOAD_NUM_PER_TIME, DOWNLOAD_NUM_MIN, DOWNLOAD_NUM_PER_TIME,
+                               DOWNLOAD_TARGET_TIME)
 
-        # OVID system allows to download maximum 500 documents per time
-        list_range = chunks_by_element(range(1, search_ret_num+1), DOWNLOAD_NUM_PER_TIME)
+        # files of earlier runs
+        known_files = list_downloaded_files(topic_dir)
+        download_num = 0
+        chunk_num = 0
 
-        for item in list_range:
+        for item in sizer.chunks(range(1, search_ret_num+1)):
+            chunk_start = time.time()
+            chunk_num += 1
 
             # input range, e.g. 1-500
             download_range = driver.find_element_by_xpath('//*[@id="titles-display"]//input[@title="Range"]')
@@ -367,120 +1341,282 @@ def download_pid_by_topic_id(topic_id, str_search_query):
             download = driver.find_element_by_xpath('//div[@class ="export-citation-buttons"]')
             download.click()
 
+            # wait until the export file is completely downloaded
+            new_files = wait_for_downloads(topic_dir, known_files, 1, DOWNLOAD_CHUNK_TIMEOUT)
+            chunk_bytes = sum(os.path.getsize(os.path.join(topic_dir, f)) for f in new_files)
+            sizer.observe(len(item), time.time() - chunk_start, chunk_bytes, ok=bool(new_files))
+            if new_files and STAGE_COMPRESSION['download_pids']:
+                new_files = set(os.path.basename(compress_file(os.path.join(topic_dir, f),
+                                                               STAGE_COMPRESSION['download_pids']))
+                                for f in new_files)
+            if new_files:
+                known_files |= new_files
+                download_num += 1
+                RUN_REPORT.record('ovid_export', time.time() - chunk_start, records=len(item), topic=topic_id,
+                                  bytes=chunk_bytes, range='{}-{}'.format(item[0], item[-1]))
+            else:
+                record_log(topic_id=topic_id, search_query=str_search_query,
+                           err_msg='export of records {}-{} not downloaded in {}s.'.format(
+                               item[0], item[-1], DOWNLOAD_CHUNK_TIMEOUT))
+                RUN_REPORT.record('ovid_export', time.time() - chunk_start, topic=topic_id, error='timeout',
+                                  range='{}-{}'.format(item[0], item[-1]))
+
+        print('topic {}: {}/{} export files downloaded'.format(topic_id, download_num, chunk_num))
+
     finally:
-        sleep(30)  # wait for finishing downloading the last file
-        # driver.implicitly_wait(30)  # doesn't work!
-        driver.quit()
+        if own_driver:
+            driver.quit()
+        else:
+            close_other_windows(driver, current_window_handle)
 
-    return
+    return download_num == chunk_num
 
 
-def batch_download_pid():
+@timed_stage
+def batch_download_pid(pool_size=DRIVER_POOL_SIZE, only_failed=False):
     """
     Download pids for all systematic reviews
+    :param pool_size: int, browser sessions
+    :param only_failed: bool, only retry the topics in the failure queue
     :return:
     """
     # read clef reviews
     dict_review = read_ovid_search_file()
-
-    # download pids
-    for topic_id in dict_review.keys():
-        download_pid_by_topic_id(topic_id, dict_review[topic_id]['query'])
+    manifest = StageManifest('download_pids')
+
+    def download(driver, topic_id):
+        params = {'query': dict_review[topic_id]['query']}
+        topic_dir = os.path.join(DOWNLOAD_PIDS_DIR, str(topic_id))
+
+        # remove files of an unfinished or stale earlier download
+        if os.path.exists(topic_dir):
+            for mfile in os.listdir(topic_dir):
+                os.remove(os.path.join(topic_dir, mfile))
+
+        complete = download_pid_by_topic_id(topic_id, params['query'], driver, sizer)
+        if complete:
+            manifest.mark_done(topic_id, outputs=[os.path.join(topic_dir, f) for f in get_file_ids(topic_dir)],
+                               params=params)
+            update_failure_queue(remove=[('ovid', topic_id)])
+        else:
+            manifest.mark_failed(topic_id, 'incomplete download, see log.txt', params)
+        return complete
+
+    def record_failure(topic_id, error):
+        params = {'query': dict_review[topic_id]['query']}
+        manifest.mark_failed(topic_id, error, params)
+        update_failure_queue(add=[{'kind': 'ovid', 'key': topic_id, 'error': repr(error), 'payload': params}])
+
+    list_topic = [topic_id for topic_id in dict_review.keys()
+                  if not manifest.is_done(topic_id, params={'query': dict_review[topic_id]['query']})]
+    if only_failed:
+        failed = read_failure_queue('ovid')
+        list_topic = [topic_id for topic_id in list_topic if topic_id in failed]
+    print('{} of {} topics are downloaded already'.format(len(dict_review) - len(list_topic), len(dict_review)))
+
+    # download pids, topics are scheduled onto the browser sessions and share the export size
+    sizer = BatchSizer('ovid_export', DOWNLOAD_NUM_PER_TIME, DOWNLOAD_NUM_MIN, DOWNLOAD_NUM_PER_TIME,
+                       DOWNLOAD_TARGET_TIME)
+    pool = DriverPool(size=pool_size, on_failure=record_failure)
+    try:
+        pool.map(download, list_topic)
+    finally:
+        pool.close()
+        manifest.save()
+    sizer.summary()
 
     return
 
 
-def extract_pid():
+def date_bounds(date_range):
+    """
+    Parse the date limit of a topic once
+    :param date_range: str, e.g. '20000101 - 20171230'
+    :return: tuple of int, (start date, end date) as YYYYMMDD
+    """
+    start_date, end_date = re.findall(r'\d+', date_range)
+    return int(start_date), int(end_date)
+
+
+def iter_ovid_records(path):
+    """
+    Stream the records of an Ovid export xml
+    :param path: str
+    :return: generator of (index, unique identifier, date created as int YYYYMMDD or None)
+    """
+    with open_compressed(path) as f:
+        for record in iter_ovid_file(f):
+            yield record
+
+
+def iter_ovid_file(f):
+    """
+    :param f: file object of an Ovid export xml
+    :return: generator, see iter_ovid_records
+    """
+    context = ET.iterparse(f, events=('start', 'end'))
+    root = next(context)[1]
+
+    for event, r in context:
+        if 'end' != event or 'record' != r.tag:
+            continue
+
+        inx = int(re.findall(r'\d+', r.get('index', ''))[0])
+        ui = ''
+        test_date = None
+        for f in r.iter('F'):
+            if f.get('L') == u'Unique Identifier':
+                ui = get_element_text(f.find('.//D'))
+
+            if f.get('L') == u'Date Created':
+                test_date = int(get_element_text(f.find('.//D')))
+
+        yield inx, ui, test_date
+
+        # free the finished record
+        root.clear()
+
+
+def extract_pid_task(task):
+    """
+    Extract the pids of one Ovid export file that satisfy the date constraint. Runs in a worker process.
+    :param task: tuple, (topic_id, mfile, file_no, start_date, end_date)
+    :return: tuple, (topic_id, file_no, list of (index, file_no, position, pid) sorted by index, seconds)
+    """
+    topic_id, mfile, file_no, start_date, end_date = task
+    print('processing topic {} file {}'.format(topic_id, mfile))
+    start_time = time.time()
+
+    list_ret = []
+    for seq, (inx, ui, test_date) in enumerate(iter_ovid_records(os.path.join(DOWNLOAD_PIDS_DIR, topic_id, mfile))):
+        # filter based on data
+        if test_date is not None and start_date < test_date < end_date:
+            list_ret.append((inx, file_no, seq, ui))
+        else:
+            print('Document {} in file {} in topic {} does not satisfy year constraint.'.format(inx, mfile, topic_id))
+
+    # records of an export are in index order already, so this is a linear check
+    list_ret.sort()
+    return topic_id, file_no, list_ret, time.time() - start_time
+
+
+@timed_stage
+def extract_pid(workers=1):
     """
     Extract pids from downloaded xml, filter out those that do not satisfy date constraint,
     and rewrite the left pids to new dir.
+    :param workers: int, processes parsing export files in parallel, of several topics at once
     :return:
     """
 
     # get year constraints
     dict_review = read_ovid_search_file()
+    manifest = StageManifest('extract')
 
+    dict_unit = {}
+    tasks = []
     for topic_id in get_dirs(DOWNLOAD_PIDS_DIR):
-        # read download pids data
-        list_ret = []
-        for mfile in get_file_ids(os.path.join(DOWNLOAD_PIDS_DIR, topic_id)):
-            print('processing topic {} file {}'.format(topic_id, mfile))
-
-            # date range
-            date_range = dict_review[topic_id]['date']
-            start_date, end_date = re.findall(r'\d+', date_range)
-            start_date = datetime.datetime.strptime(start_date, "%Y%m%d")  # e.g. 20171230
-            end_date = datetime.datetime.strptime(end_date, "%Y%m%d")
-
-            # open xml
-            dom = xml.dom.minidom.parse(os.path.join(DOWNLOAD_PIDS_DIR, topic_id, mfile))
-
-            # get root elements
-            root = dom.documentElement
-
-            for r in root.getElementsByTagName('record'):
-                inx = 0
-                ui = ''
-                test_date = ''
-
-                inx = r.getAttribute('index')
-                inx = int(re.findall(r'\d+', inx)[0])
-
-                for f in r.getElementsByTagName('F'):
-                    if f.getAttribute('L') == u'Unique Identifier':
-                        ui = get_tag_text(f, 'D')
-
-                    if f.getAttribute('L') == u'Date Created':
-                        test_date = get_tag_text(f, 'D')
-                        test_date = datetime.datetime.strptime(test_date.encode('utf-8'), "%Y%m%d")
-
-                # filter based on data
-                if test_date < end_date and test_date > start_date:
-                    list_ret.append((inx, ui))
-                else:
-                    print('Document {} in file {} in topic {} does not satisfy year constraint.'.format(inx, mfile, topic_id))
+        list_file = get_file_ids(os.path.join(DOWNLOAD_PIDS_DIR, topic_id))
+        inputs = [os.path.join(DOWNLOAD_PIDS_DIR, topic_id, mfile) for mfile in list_file]
+        params = {'date': dict_review[topic_id]['date']}
+        if manifest.is_done(topic_id, inputs, params):
+            print('topic {} is extracted already'.format(topic_id))
+            continue
+
+        # date range, e.g. 20171230
+        start_date, end_date = date_bounds(dict_review[topic_id]['date'])
 
-        # sort
-        list_ret.sort(key=itemgetter(0))
+        dict_unit[topic_id] = (inputs, params, [None] * len(list_file))
+        tasks.extend((topic_id, mfile, file_no, start_date, end_date) for file_no, mfile in enumerate(list_file))
 
-        # output release data
+    def write_topic(topic_id):
+        inputs, params, runs = dict_unit.pop(topic_id)
+
+        # k-way merge of the sorted files, same order as a stable sort by index
         with codecs.open(os.path.join(PIDS_DIR, os.path.basename(topic_id)), 'w', 'utf-8') as f:
-            for inx, ui in list_ret:
-                f.write('{}\n'.format(ui))
+            f.write(u''.join(u'{}\n'.format(ui) for inx, file_no, seq, ui in heapq.merge(*runs)))
+
+        manifest.mark_done(topic_id, inputs, [os.path.join(PIDS_DIR, os.path.basename(topic_id))], params)
+
+    # topics without export files
+    for topic_id in [topic_id for topic_id in dict_unit if not dict_unit[topic_id][2]]:
+        write_topic(topic_id)
+
+    with run_tasks(extract_pid_task, tasks, workers, ordered=False, manifest=manifest) as results:
+        for topic_id, file_no, list_ret, elapsed in results:
+            inputs, params, runs = dict_unit[topic_id]
+            RUN_REPORT.record('extract_file', elapsed, bytes=os.path.getsize(inputs[file_no]), records=len(list_ret),
+                              topic=topic_id, file=os.path.basename(inputs[file_no]))
+            runs[file_no] = list_ret
+            if all(run is not None for run in runs):
+                write_topic(topic_id)
     return
 
 
-def download_title_by_url(review_url):
+def download_title_by_url(review_url, driver=None):
     """
     Download titles by systematic review url
     :param review_url:
+    :param driver: browser session to reuse, e.g. from DriverPool. Default starts a new one.
     :return:
     """
     print('processing {}'.format(review_url))
 
     # start chrome browser
-    chromedriver = CHROMEDRIVER_DIR
-    os.environ["webdriver.chrome.driver"] = chromedriver
-    driver = webdriver.Chrome(executable_path=chromedriver)
-
-    # request and response of website
-    driver.get(review_url)
+    own_driver = driver is None
+    if own_driver:
+        driver = make_chrome_driver()
 
-    # get title
-    title = driver.find_element_by_xpath('//h1[@class="article-header__title"]').text
+    try:
+        with RUN_REPORT.span('title', url=review_url):
+            # request and response of website
+            driver.get(review_url)
 
-    driver.quit()
+            # get title
+            title = driver.find_element_by_xpath('//h1[@class="article-header__title"]').text
+    finally:
+        if own_driver:
+            driver.quit()
 
     return title
 
 
-def batch_download_title():
+@timed_stage
+def batch_download_title(pool_size=DRIVER_POOL_SIZE):
     """
     Download title for all the systematic reviews
+    :param pool_size: int, browser sessions
     :return:
     """
     # read clef reviews
     dict_review = read_ovid_search_file()
+    list_topic = list(dict_review.keys())
+    manifest = StageManifest('title')
+
+    def download(driver, topic_id):
+        params = {'url': dict_review[topic_id]['url']}
+        title = download_title_by_url(params['url'], driver)
+        manifest.mark_done(topic_id, params=params, result=title)
+        update_failure_queue(remove=[('title', topic_id)])
+        return title
+
+    def record_failure(topic_id, error):
+        params = {'url': dict_review[topic_id]['url']}
+        manifest.mark_failed(topic_id, error, params)
+        update_failure_queue(add=[{'kind': 'title', 'key': topic_id, 'error': repr(error), 'payload': params}])
+
+    # titles downloaded by earlier runs
+    dict_title = dict((topic_id, manifest.result(topic_id)) for topic_id in list_topic
+                      if manifest.is_done(topic_id, params={'url': dict_review[topic_id]['url']}))
+    list_download = [topic_id for topic_id in list_topic if topic_id not in dict_title]
+
+    # download titles, urls are scheduled onto the browser sessions
+    pool = DriverPool(size=pool_size, on_failure=record_failure)
+    try:
+        dict_title.update(zip(list_download, pool.map(download, list_download)))
+    finally:
+        pool.close()
+        manifest.save()
 
     # clear before writing
     with codecs.open(TITLE_DIR, 'w', encoding='utf-8'):
@@ -488,8 +1624,11 @@ def batch_download_title():
 
     # write title
     with codecs.open(TITLE_DIR, 'a', encoding='utf-8') as f:
-        for topic_id in dict_review.keys():
-            title = download_title_by_url(dict_review[topic_id]['url'])
+        for topic_id in list_topic:
+            title = dict_title[topic_id]
+            if title is None:
+                print('title of topic {} is not downloaded, see {}'.format(topic_id, FAILURE_QUEUE_FILE))
+                continue
             f.write('%s ||| %s \n' % (topic_id, title))
     return
 
@@ -503,16 +1642,91 @@ def read_title():
     return dict_title
 
 
-def make_release_file(qrel_type):
+# topic pids file -> (mtime, unique pids)
+_PIDS_CACHE = {}
+
+
+def unique_pids(pids):
     """
-    Make topic file or qrel file
-    :param qrel_type: str. 'topic', 'abs', 'doc'.
-    :return:
+    Remove duplicate pids and keep the original order
+    :param pids: iterable of str
+    :return: list
     """
-    # get review relevance
-    dict_rel = read_clef_rel(qrel_type=qrel_type)
+    seen = set()
+    ret = []
+    for pid in pids:
+        if pid not in seen:
+            seen.add(pid)
+            ret.append(pid)
+    return ret
 
-    # get review dict
+
+def read_pids(topic_id):
+    """
+    Read the unique pids of a topic in their original order.
+    The result is cached until the pids file changes, so callers must not modify it.
+    :param topic_id: str
+    :return: list
+    """
+    path = os.path.join(PIDS_DIR, topic_id)
+    mtime = os.path.getmtime(path)
+    if path in _PIDS_CACHE and _PIDS_CACHE[path][0] == mtime:
+        return _PIDS_CACHE[path][1]
+
+    with codecs.open(path, 'r', 'utf-8') as fr:
+        list_boolean = unique_pids(l.strip() for l in fr)
+    _PIDS_CACHE[path] = (mtime, list_boolean)
+    return list_boolean
+
+
+def format_qrel(review_doi, list_boolean, judgements):
+    """
+    Make the qrel file content of a topic
+    :param review_doi: str
+    :param list_boolean: list of str, pids
+    :param judgements: dict, pmid -> relevance
+    :return: unicode
+    """
+    return u''.join(u'%-12s %-2d %-12s %-2s \n' % (review_doi, 0, item.strip(), judgements.get(item.strip(), 0))
+                    for item in list_boolean)
+
+
+def format_topic(review_doi, title, query, list_boolean):
+    """
+    Make the topic file content of a topic
+    :param review_doi: str
+    :param title: str
+    :param query: str
+    :param list_boolean: list of str, pids
+    :return: unicode
+    """
+    return u'Topic: %s \n\nTitle: %s \n\nQuery: \n%s \n\nPids: \n%s' % (
+        review_doi, title, query, u''.join(u'    %s \n' % pid for pid in list_boolean))
+
+
+def write_release_file(path, content):
+    """
+    Write a release file with one buffered write
+    :param path: str
+    :param content: unicode
+    :return:
+    """
+    with codecs.open(path, 'w', encoding='utf-8') as fw:
+        fw.write(content)
+    return
+
+
+@timed_stage
+def make_release_file(qrel_type):
+    """
+    Make topic file or qrel file
+    :param qrel_type: str. 'topic', 'abs', 'doc'.
+    :return:
+    """
+    # get review relevance
+    dict_rel = read_clef_rel(qrel_type=qrel_type)
+
+    # get review dict
     dict_review = read_ovid_search_file()
 
     # get review titles
@@ -523,13 +1737,7 @@ def make_release_file(qrel_type):
         assert topic_id in dict_review.keys(), 'topic {} not in medline_ovid_search.xlsx'.format(topic_id)
 
         # read pids
-        with codecs.open(os.path.join(PIDS_DIR, topic_id), 'r', 'utf-8') as fr:
-            list_boolean = []
-            local = []
-            for l in fr:
-                if l.strip() not in local:
-                    list_boolean.append(l.strip())
-                    local.append(l.strip())  # remove duplicate pids and keep the original order
+        list_boolean = read_pids(topic_id)
 
         review_doi = dict_review[topic_id]['review_doi']
         title = dict_title[topic_id]
@@ -537,178 +1745,2222 @@ def make_release_file(qrel_type):
 
         # write qrel file or topic file
         if 'abs' == qrel_type:
-            with codecs.open(os.path.join(ABS_QREL_DIR, topic_id), 'w', 'utf-8') as fw:
-                for item in list_boolean:
-                    fw.write('%-12s %-2d %-12s %-2s \n' % (review_doi, 0, item.strip(),
-                                                           dict_rel[review_doi].get(item.strip(), 0)))
+            write_release_file(os.path.join(ABS_QREL_DIR, topic_id), format_qrel(review_doi, list_boolean,
+                                                                                 dict_rel[review_doi]))
 
-        if 'doc' == qrel_type:
-            with codecs.open(os.path.join(DOC_QREL_DIR, topic_id), 'w', 'utf-8') as fw:
-                for item in list_boolean:
-                    fw.write('%-12s %-2d %-12s %-2s \n' % (review_doi, 0, item.strip(),
-                                                           dict_rel[review_doi].get(item.strip(), 0)))
+        elif 'doc' == qrel_type:
+            write_release_file(os.path.join(DOC_QREL_DIR, topic_id), format_qrel(review_doi, list_boolean,
+                                                                                 dict_rel[review_doi]))
 
         elif 'topic' == qrel_type:
-            with codecs.open(os.path.join(TOPIC_DIR, topic_id), 'w', encoding='utf-8') as fw:
-                fw.write('Topic: %s \n\n' % review_doi)
-                fw.write('Title: %s \n\n' % title)
-                fw.write('Query: \n%s \n\n' % query)
-                fw.write('Pids: \n')
-                {fw.write('    %s \n' % pid) for pid in list_boolean}
+            write_release_file(os.path.join(TOPIC_DIR, topic_id), format_topic(review_doi, title, query,
+                                                                               list_boolean))
         else:
             pass
 
     return
 
 
-def download_abstract():
+def make_release_task(task):
     """
-    Download abstract for all the pids
+    Make topic file, abs qrel file and doc qrel file of one topic. Runs in a worker process.
+    :param task: tuple, (topic_id, review_doi, title, query, abs judgements, doc judgements)
+    :return: tuple, (topic_id, pid num, seconds)
+    """
+    topic_id, review_doi, title, query, abs_rel, doc_rel = task
+    start_time = time.time()
+
+    # read pids once for all three files
+    list_boolean = read_pids(topic_id)
+
+    write_release_file(os.path.join(TOPIC_DIR, topic_id), format_topic(review_doi, title, query, list_boolean))
+    write_release_file(os.path.join(ABS_QREL_DIR, topic_id), format_qrel(review_doi, list_boolean, abs_rel))
+    write_release_file(os.path.join(DOC_QREL_DIR, topic_id), format_qrel(review_doi, list_boolean, doc_rel))
+
+    return topic_id, len(list_boolean), time.time() - start_time
+
+
+@timed_stage
+def make_release_files(workers=1):
+    """
+    Make topic files, abs qrel files and doc qrel files in one pass over the pids
+    :param workers: int, processes making topics in parallel
     :return:
     """
-    # read boolean result
+    # load inputs once
+    dict_abs = read_clef_rel(qrel_type='abs')
+    dict_doc = read_clef_rel(qrel_type='doc')
+    dict_review = read_ovid_search_file()
+    dict_title = read_title()
+
+    manifest = StageManifest('release')
+
+    def unit(topic_id):
+        review_doi = dict_review[topic_id]['review_doi']
+        inputs = [os.path.join(PIDS_DIR, topic_id), os.path.join(BASE_DIR, RELEVANCE_INDEX_FILE)]
+        outputs = [os.path.join(TOPIC_DIR, topic_id), os.path.join(ABS_QREL_DIR, topic_id),
+                   os.path.join(DOC_QREL_DIR, topic_id)]
+        params = {'review_doi': review_doi, 'title': dict_title[topic_id], 'query': dict_review[topic_id]['query']}
+        return inputs, outputs, params
+
+    tasks = []
     for topic_id in get_file_ids(PIDS_DIR):
-        print('processing systematic review {}'.format(topic_id))
 
-        # get pids
-        with codecs.open(os.path.join(PIDS_DIR, topic_id), 'r', 'utf-8') as fr:
-            list_boolean = []
-            local = []
-            for l in fr:
-                if l.strip() not in local:
-                    list_boolean.append(l.strip())
-                    local.append(l.strip())  # remove duplicate pids and keep the original order
-
-        # make directory for corpora
-        dir_document = os.path.join(CORPORA_DIR, str(topic_id))
-        if not os.path.exists(dir_document):
-            os.makedirs(dir_document)
+        assert topic_id in dict_review.keys(), 'topic {} not in medline_ovid_search.xlsx'.format(topic_id)
+
+        # the title download failed, see batch_download_title
+        if topic_id not in dict_title:
+            print('skip release files of topic {}: its title is not downloaded, run the title command again'.format(
+                topic_id))
+            continue
 
-        # send request
-        for block, pids in enumerate(chunks_by_element(list_boolean, 500)):
-            str_pids = ','.join(pids)
-            payload = {'db': 'pubmed', 'id': str_pids, 'rettype': 'xml', 'retmode': 'xml'}
-            r = requests.get(NCBI_API_URL, params=payload)
+        inputs, outputs, params = unit(topic_id)
+        if manifest.is_done(topic_id, inputs, params):
+            continue
 
-            # write
-            with codecs.open(os.path.join(dir_document, str(block)), 'w', 'utf-8') as f:
-                f.write(r.content.decode('utf-8'))
+        review_doi = dict_review[topic_id]['review_doi']
+        tasks.append((topic_id, review_doi, dict_title[topic_id], dict_review[topic_id]['query'],
+                      dict_abs.get(review_doi, {}), dict_doc.get(review_doi, {})))
+
+    pid_num = 0
+    with run_tasks(make_release_task, tasks, workers, manifest=manifest) as results:
+        for topic_id, n, elapsed in results:
+            inputs, outputs, params = unit(topic_id)
+            manifest.mark_done(topic_id, inputs, outputs, params)
+            RUN_REPORT.record('release_topic', elapsed, bytes=sum(os.path.getsize(path) for path in outputs),
+                              records=n, topic=topic_id)
+            pid_num += n
+
+    print('made release files for {} topics, {} pids'.format(len(tasks), pid_num))
+    return
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket, used to keep requests under a per-second quota.
+    """
 
-        sleep(5)
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: float, tokens added per second
+        :param capacity: int, maximum burst size
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.timestamp = time.time()  # tokens are counted up to here, later while paused
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for a while, e.g. after the server asked to retry later
+        :param seconds: float
+        :return:
+        """
+        with self.lock:
+            self.tokens = 0.0
+            self.timestamp = max(self.timestamp, time.time() + seconds)
+        return
+
+    def acquire(self):
+        """
+        Block until a token is available and take it.
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now > self.timestamp:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                    self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = self.timestamp - now + (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class BatchSizer(object):
+    """
+    Batch size controller of one endpoint, shared by its worker threads.
+    A failed batch halves the size, a batch slower than the target or larger than the byte limit cuts it
+    by a quarter, and a batch of the current size done in less than half the target grows it by a step.
+    Every observation is kept, to report the chosen sizes and their throughput.
+    """
+
+    def __init__(self, name, initial, minimum, maximum, target_time, target_bytes=None):
+        """
+        :param name: str, endpoint, e.g. 'efetch'
+        :param initial: int, first batch size
+        :param minimum: int
+        :param maximum: int
+        :param target_time: float, second per batch
+        :param target_bytes: int, response bytes per batch. None is no limit.
+        """
+        self.name = name
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = max(1, initial // 4)
+        self.target_time = target_time
+        self.target_bytes = target_bytes
+        self.history = []  # (size, seconds, bytes, ok)
+        self.lock = threading.Lock()
+
+    def next_size(self):
+        """
+        :return: int, size of the next batch
+        """
+        with self.lock:
+            return self.size
+
+    def observe(self, size, seconds, bytes=0, ok=True):
+        """
+        Adjust the size from a finished batch
+        :param size: int, size of the batch
+        :param seconds: float
+        :param bytes: int, response size
+        :param ok: bool, False if the batch failed or timed out
+        :return:
+        """
+        with self.lock:
+            self.history.append((size, seconds, bytes, ok))
+            if not ok:
+                self.size = min(self.size, size // 2)
+            elif seconds > self.target_time or (self.target_bytes is not None and bytes > self.target_bytes):
+                self.size = min(self.size, size * 3 // 4)
+            elif seconds < self.target_time / 2.0 and size >= self.size:
+                self.size += self.step
+            self.size = max(self.minimum, min(self.maximum, self.size))
+        return
+
+    def chunks(self, arr):
+        """
+        Split a list into batches of the current size, decided as each batch is taken
+        :param arr: list
+        :return: generator of lists
+        """
+        start = 0
+        while start < len(arr):
+            size = self.next_size()
+            yield arr[start:start + size]
+            start += size
+
+    def summary(self):
+        """
+        Record the chosen sizes and their throughput in RUN_REPORT
+        :return: dict
+        """
+        with self.lock:
+            history = list(self.history)
+        done = [(size, seconds, bytes) for size, seconds, bytes, ok in history if ok]
+        seconds = sum(item[1] for item in history)
+        summary = {'endpoint': self.name, 'batches': len(history), 'failures': len(history) - len(done),
+                   'min_size': min(item[0] for item in history) if history else self.size,
+                   'max_size': max(item[0] for item in history) if history else self.size,
+                   'final_size': self.size}
+        RUN_REPORT.record('batch_sizer', seconds, bytes=sum(item[2] for item in done),
+                          records=sum(item[0] for item in done), retries=summary['failures'], **summary)
+        print('{} batches: {} done, {} failed, size {} - {}, final {}, {:.1f} docs/sec'.format(
+            self.name, len(done), summary['failures'], summary['min_size'], summary['max_size'], self.size,
+            sum(item[0] for item in done) / max(seconds, 1e-6)))
+        return summary
+
+
+class EfetchError(Exception):
+    """
+    An efetch request that failed after all retries
+    """
+    pass
+
+
+class EfetchClient(object):
+    """
+    Pooled efetch client: one persistent session, a token bucket set to the NCBI quota
+    and a bounded number of requests in flight. Failed requests are retried with backoff.
+    """
+
+    def __init__(self, api_url=NCBI_API_URL, api_key=NCBI_API_KEY, max_in_flight=EFETCH_MAX_IN_FLIGHT, rate=None,
+                 sizer=None):
+        """
+        :param api_url: str, efetch endpoint, e.g. a local stub server
+        :param api_key: str, NCBI api key, raises the default quota
+        :param max_in_flight: int, concurrent requests
+        :param rate: float, requests per second. Default is the NCBI quota.
+        :param sizer: BatchSizer told the latency, bytes and outcome of every request
+        """
+        if rate is None:
+            rate = NCBI_REQUESTS_PER_SECOND_WITH_KEY if api_key else NCBI_REQUESTS_PER_SECOND
+
+        self.api_url = api_url
+        self.api_key = api_key
+        self.max_in_flight = max_in_flight
+        self.limiter = TokenBucket(rate)
+        self.sizer = sizer
+
+        # keep-alive connections, one per request in flight
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, pids):
+        """
+        Fetch the PubmedArticleSet xml for a list of pids.
+        Connection errors, EFETCH_RETRY_STATUS responses and truncated xml are retried up to EFETCH_RETRIES times
+        after backoff_delay. A Retry-After or a 429 pauses all requests of the client, not only this one.
+        A response with fewer articles than pids is returned, the missing pids are queued by parse_efetch_response.
+        Only one missing more than EFETCH_INCOMPLETE_SHORTFALL of them is retried EFETCH_INCOMPLETE_RETRIES times.
+        :param pids: list of str
+        :return: bytes
+        """
+        payload = {'db': 'pubmed', 'id': ','.join(pids), 'rettype': 'xml', 'retmode': 'xml'}
+        if self.api_key:
+            payload['api_key'] = self.api_key
+
+        with RUN_REPORT.span('efetch', ids=len(pids)) as span:
+            incomplete_num = 0
+            for attempt in range(EFETCH_RETRIES + 1):
+                self.limiter.acquire()
+                request_time = time.time()
+                status = None
+                retry_after = None
+                observed = False
+                try:
+                    if len(pids) > EFETCH_POST_THRESHOLD:
+                        r = self.session.post(self.api_url, data=payload, timeout=EFETCH_TIMEOUT)
+                    else:
+                        r = self.session.get(self.api_url, params=payload, timeout=EFETCH_TIMEOUT)
+                    status = r.status_code
+                except requests.RequestException as e:
+                    error = 'request failed: {!r}'.format(e)
+                else:
+                    if 200 == status:
+                        content = r.content
+                        article_num = content.count(b'<PubmedArticle>') + content.count(b'<PubmedBookArticle>')
+                        if not content.rstrip().endswith(b'</PubmedArticleSet>'):
+                            error = 'truncated response'
+                        elif (len(pids) - article_num > EFETCH_INCOMPLETE_SHORTFALL * len(pids)
+                              and incomplete_num < EFETCH_INCOMPLETE_RETRIES):
+                            incomplete_num += 1
+                            error = '{} articles for {} ids'.format(article_num, len(pids))
+                            # missing articles are not a failure of the batch size
+                            if self.sizer is not None:
+                                self.sizer.observe(len(pids), time.time() - request_time, len(content))
+                            observed = True
+                        else:
+                            span.add(bytes=len(content), records=article_num)
+                            if self.sizer is not None:
+                                self.sizer.observe(len(pids), time.time() - request_time, len(content))
+                            return content
+                    elif status in EFETCH_RETRY_STATUS:
+                        error = 'HTTP {}'.format(status)
+                        retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                    else:
+                        raise EfetchError('HTTP {}: {}'.format(status, r.text[:200]))
+
+                if self.sizer is not None and not observed:
+                    self.sizer.observe(len(pids), time.time() - request_time, ok=False)
+                if attempt == EFETCH_RETRIES:
+                    break
+                delay = backoff_delay(attempt, retry_after)
+                print('efetch of {} ids failed ({}), retry in {:.1f}s'.format(len(pids), error, delay))
+                span.add(retries=1)
+                if retry_after is not None or 429 == status:
+                    self.limiter.pause(delay)
+                else:
+                    sleep(delay)
+
+        raise EfetchError('{} after {} retries'.format(error, EFETCH_RETRIES))
+
+    def fetch_all(self, tasks):
+        """
+        Fetch many id lists concurrently, yielding results in submission order.
+        At most 2 * max_in_flight responses are held in memory.
+        :param tasks: iterable of (key, pids)
+        :return: generator of (key, pids, content, error), content is None if the request failed
+        """
+        def result(future):
+            try:
+                return future.result(), None
+            except EfetchError as e:
+                return None, e
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        pending = deque()
+        try:
+            for key, pids in tasks:
+                pending.append((key, pids, executor.submit(self.fetch, pids)))
+                if len(pending) >= 2 * self.max_in_flight:
+                    key, pids, future = pending.popleft()
+                    yield (key, pids) + result(future)
+            while pending:
+                key, pids, future = pending.popleft()
+                yield (key, pids) + result(future)
+        finally:
+            executor.shutdown(wait=True)
+
+    def close(self):
+        self.session.close()
+
+
+def open_abstract_store(path=None):
+    """
+    Open the shared abstract store: one PubmedArticle xml per pmid, shared by all topics.
+    :param path: str, sqlite file. Default is ABSTRACT_STORE_FILE.
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(path or ABSTRACT_STORE_FILE)
+    conn.execute('CREATE TABLE IF NOT EXISTS abstract (pmid TEXT PRIMARY KEY, xml TEXT NOT NULL, fetched_at REAL, '
+                 'changed_at REAL)')
+    # stores made before changed_at was kept
+    if 'changed_at' not in [row[1] for row in conn.execute('PRAGMA table_info(abstract)')]:
+        conn.execute('ALTER TABLE abstract ADD COLUMN changed_at REAL')
+        conn.execute('UPDATE abstract SET changed_at = fetched_at')
+        conn.commit()
+    return conn
+
+
+def split_pubmed_articles(content):
+    """
+    Split an efetch response into its articles
+    :param content: bytes, PubmedArticleSet xml
+    :return: generator of (pmid, article xml)
+    """
+    depth = 0
+    for event, elem in ET.iterparse(BytesIO(content), events=('start', 'end')):
+        if 'start' == event:
+            depth += 1
+            continue
+        depth -= 1
+        if 1 == depth and elem.tag in ('PubmedArticle', 'PubmedBookArticle'):
+            pmid = elem.find('.//PMID')
+            if pmid is not None:
+                elem.tail = None
+                yield pmid.text.strip(), ET.tostring(elem).decode('ascii')
+            elem.clear()
+
+
+def read_stored_abstracts(conn, pids, column='xml'):
+    """
+    Read articles of the given pids from the abstract store
+    :param conn: sqlite3.Connection
+    :param pids: list of str
+    :param column: str, 'xml', 'fetched_at' or 'changed_at'
+    :return: dict, pmid -> article xml, or the value of column
+    """
+    dict_article = {}
+    for part in chunks_by_element(pids, 999):  # sqlite variable limit
+        cursor = conn.execute('SELECT pmid, {} FROM abstract WHERE pmid IN ({})'.format(
+            column, ','.join('?' * len(part))), part)
+        dict_article.update(cursor.fetchall())
+    return dict_article
+
+
+def store_articles(conn, articles):
+    """
+    Save fetched articles to the abstract store. An article identical to the stored one only gets
+    its fetched_at renewed, so that the blocks holding it are not rewritten.
+    :param conn: sqlite3.Connection
+    :param articles: list of (pmid, article xml)
+    :return: int, number of new or changed articles
+    """
+    now = time.time()
+    dict_stored = read_stored_abstracts(conn, [pmid for pmid, article in articles])
+    changed = [(pmid, article, now, now) for pmid, article in articles if dict_stored.get(pmid) != article]
+    conn.executemany('INSERT OR REPLACE INTO abstract VALUES (?, ?, ?, ?)', changed)
+    conn.executemany('UPDATE abstract SET fetched_at = ? WHERE pmid = ?',
+                     [(now, pmid) for pmid, article in articles if dict_stored.get(pmid) == article])
+    conn.commit()
+    return len(changed)
+
+
+def block_stamp(pids, dict_changed):
+    """
+    :param pids: list of str, pids of a block
+    :param dict_changed: dict, pmid -> changed_at of the stored article
+    :return: str, sha1 over the pids of a block and the versions of their stored articles
+    """
+    sha1 = hashlib.sha1()
+    for pid in pids:
+        sha1.update('{} {!r}\n'.format(pid, dict_changed.get(pid)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def corpus_block_text(pids, dict_article):
+    """
+    :param pids: list of str, pids of a block
+    :param dict_article: dict, pmid -> stored article xml
+    :return: unicode, PubmedArticleSet xml of the stored articles of the block, in pid order
+    """
+    text = [u'<?xml version="1.0" ?>\n<PubmedArticleSet>\n']
+    for pid in pids:
+        if pid in dict_article:
+            text.append(dict_article[pid])
+            text.append(u'\n')
+    text.append(u'</PubmedArticleSet>\n')
+    return u''.join(text)
+
+
+def remove_stale_blocks(path, topic_id, pids):
+    """
+    Remove the block files of a topic left by a longer earlier pid list
+    :param path: str, CORPORA_DIR or TRECTEXT_DIR
+    :param topic_id: str
+    :param pids: list of str, unique pids of the topic
+    :return: list of removed file names
+    """
+    names = set(str(block) for block in range(int(math.ceil(len(pids) / float(EFETCH_NUM_PER_TIME)))))
+    removed = [mfile for mfile in get_file_ids(os.path.join(path, topic_id)) if strip_compression(mfile) not in names]
+    for mfile in removed:
+        os.remove(os.path.join(path, topic_id, mfile))
+    return removed
+
+
+def write_topic_corpus(conn, topic_id, list_boolean, manifest=None, dict_changed=None):
+    """
+    Write the corpus of a topic, a copy of its articles in the abstract store, to CORPORA_DIR/<topic_id>/<block>,
+    compressed as set in STAGE_COMPRESSION.
+    With a manifest, only the blocks whose pids or stored articles changed are rewritten.
+    :param conn: sqlite3.Connection
+    :param topic_id: str
+    :param list_boolean: list of str, unique pids in original order
+    :param manifest: StageManifest, with one unit per block
+    :param dict_changed: dict, pmid -> changed_at of the stored article
+    :return: list of rewritten block file paths
+    """
+    # make directory for corpora
+    dir_document = os.path.join(CORPORA_DIR, str(topic_id))
+    if not os.path.exists(dir_document):
+        os.makedirs(dir_document)
+
+    list_block = []
+    list_written = []
+    codec = STAGE_COMPRESSION['copora']
+    for block, pids in enumerate(chunks_by_element(list_boolean, EFETCH_NUM_PER_TIME)):
+        list_block.append(compressed_path(os.path.join(dir_document, str(block)), codec))
+        unit = '{}/{}'.format(topic_id, block)
+        params = {'stamp': block_stamp(pids, dict_changed or {})}
+        if codec:
+            params['compression'] = codec
+        if manifest is not None and manifest.is_done(unit, params=params):
+            continue
+
+        with RUN_REPORT.span('corpus_block', topic=topic_id, block=block) as span:
+            dict_article = read_stored_abstracts(conn, pids)
+            list_written.append(list_block[-1])
+            with open_compressed_text(list_block[-1], 'w') as f:
+                f.write(corpus_block_text(pids, dict_article))
+            span.add(bytes=os.path.getsize(list_block[-1]), records=len(dict_article))
+        if manifest is not None:
+            manifest.mark_done(unit, outputs=[list_block[-1]], params=params)
+
+    # remove blocks left by a longer earlier pid list
+    for mfile in get_file_ids(dir_document):
+        if os.path.join(dir_document, mfile) not in list_block:
+            os.remove(os.path.join(dir_document, mfile))
+    return list_written
+
+
+def select_abstract_pids(conn, dict_boolean, dict_failed, refresh_ttl=ABSTRACT_REFRESH_TTL, only_failed=False):
+    """
+    Pids over all topics that are not in the abstract store yet, or expired, each once.
+    Pids efetch did not return are left out until the failure queue is drained.
+    :param conn: sqlite3.Connection
+    :param dict_boolean: dict, topic_id -> list of pids
+    :param dict_failed: dict, efetch entries of the failure queue
+    :param refresh_ttl: float, day. None never fetches a stored article again.
+    :param only_failed: bool, only the pids in the failure queue
+    :return: list of str, new pids then expired pids
+    """
+    dict_fetched = dict(conn.execute('SELECT pmid, fetched_at FROM abstract'))
+    expire_time = time.time() - refresh_ttl * 86400 if refresh_ttl is not None else None
+    missing = []
+    expired = []
+    seen = set()
+    for topic_id in sorted(dict_boolean.keys()):
+        for pid in dict_boolean[topic_id]:
+            if pid in seen:
+                continue
+            seen.add(pid)
+            if only_failed:
+                if pid in dict_failed:
+                    missing.append(pid)
+            elif pid not in dict_fetched:
+                if EFETCH_NOT_RETURNED != dict_failed.get(pid, {}).get('error'):
+                    missing.append(pid)
+            elif expire_time is not None and (dict_fetched[pid] or 0) < expire_time:
+                expired.append(pid)
+    print('{} topic pids, {} new and {} expired to download, {} in the failure queue'.format(
+        sum(len(v) for v in dict_boolean.values()), len(missing), len(expired), len(dict_failed)))
+    return missing + expired
+
+
+def parse_efetch_response(block, pids, content, error):
+    """
+    Split an efetch response into its articles, and list the pids it failed
+    :param block: int, request number, for messages
+    :param pids: list of str, requested pids
+    :param content: bytes, PubmedArticleSet xml, None if the request failed
+    :param error: exception of the failed request
+    :return: tuple, (list of (pmid, article xml), list of failure queue entries)
+    """
+    if error is not None:
+        print('Block {} of new pids failed: {}'.format(block, error))
+        return [], [{'kind': 'efetch', 'key': pid, 'error': str(error)} for pid in pids]
+    try:
+        articles = list(split_pubmed_articles(content))
+    except ET.ParseError as e:
+        print('Block {} of new pids is not valid xml, skipped: {}'.format(block, e))
+        return [], [{'kind': 'efetch', 'key': pid, 'error': 'invalid xml: {}'.format(e)} for pid in pids]
+
+    returned = set(pmid for pmid, article in articles)
+    return articles, [{'kind': 'efetch', 'key': pid, 'error': EFETCH_NOT_RETURNED} for pid in pids
+                      if pid not in returned]
+
+
+@timed_stage
+def download_abstract(api_url=NCBI_API_URL, api_key=NCBI_API_KEY, max_in_flight=EFETCH_MAX_IN_FLIGHT,
+                      refresh_ttl=ABSTRACT_REFRESH_TTL, only_failed=False, keep_xml=True):
+    """
+    Download abstract for all the pids.
+    Every pmid is fetched once into the shared abstract store, only if it is not stored yet
+    or its stored article is older than refresh_ttl.
+    Pmids whose request failed after all retries, or that efetch did not return, are kept in the failure queue.
+    Pmids not returned are not requested again until the queue is drained with only_failed.
+    The corpus blocks of every topic whose pids or stored articles changed are then rewritten from the store,
+    so a refresh costs in proportion to the changed pids, not to the corpus.
+    :param api_url: str, efetch endpoint
+    :param api_key: str, NCBI api key
+    :param max_in_flight: int, concurrent efetch requests
+    :param refresh_ttl: float, day. None never fetches a stored article again.
+    :param only_failed: bool, only fetch the pmids in the failure queue
+    :param keep_xml: bool, also write the corpus blocks. Otherwise the xml is only kept in the abstract store,
+                     and trec_format_abstract(from_store=True) reads it from there.
+    :return:
+    """
+    # read boolean result
+    dict_boolean = {}
+    for topic_id in get_file_ids(PIDS_DIR):
+        # get pids
+        dict_boolean[topic_id] = read_pids(topic_id)
+
+    conn = open_abstract_store()
+    try:
+        dict_failed = read_failure_queue('efetch')
+        to_fetch = select_abstract_pids(conn, dict_boolean, dict_failed, refresh_ttl, only_failed)
+
+        # send requests, in batches sized by the observed latency
+        sizer = BatchSizer('efetch', EFETCH_NUM_PER_TIME, EFETCH_NUM_MIN, EFETCH_NUM_MAX, EFETCH_TARGET_TIME,
+                           EFETCH_TARGET_BYTES)
+        client = EfetchClient(api_url=api_url, api_key=api_key, max_in_flight=max_in_flight, sizer=sizer)
+        start_time = time.time()
+        doc_num = 0
+        changed_num = 0
+        failed, recovered = [], []
+        try:
+            for block, pids, content, error in client.fetch_all(enumerate(sizer.chunks(to_fetch))):
+                with RUN_REPORT.span('efetch_store', block=block) as span:
+                    articles, block_failed = parse_efetch_response(block, pids, content, error)
+                    changed_num += store_articles(conn, articles)
+                    span.add(bytes=len(content or b''), records=len(articles))
+                    if block_failed and not articles:
+                        span.attrs['error'] = block_failed[0]['error']
+                doc_num += len(articles)
+                failed.extend(block_failed)
+                recovered.extend(('efetch', pmid) for pmid, article in articles if pmid in dict_failed)
+        finally:
+            client.close()
+            update_failure_queue(add=failed, remove=recovered)
+        sizer.summary()
+
+        elapsed = time.time() - start_time
+        print('downloaded {} docs in {:.1f}s ({:.1f} docs/sec), {} new or changed, {} failed, {} recovered'.format(
+            doc_num, elapsed, doc_num / max(elapsed, 1e-6), changed_num, len(failed), len(recovered)))
+
+        if not keep_xml:
+            return
+
+        # rewrite the blocks whose pids or stored articles changed
+        manifest = StageManifest('corpora')
+        dict_changed = dict(conn.execute('SELECT pmid, changed_at FROM abstract'))
+        try:
+            for topic_id in sorted(dict_boolean.keys()):
+                written = write_topic_corpus(conn, topic_id, dict_boolean[topic_id], manifest, dict_changed)
+                if written:
+                    print('systematic review {}: {} blocks rewritten'.format(topic_id, len(written)))
+        finally:
+            manifest.save()
+    finally:
+        conn.close()
 
     return
 
 
-def trec_format_abstract():
+def get_element_text(elem):
     """
-    Make the downloaded abstract TRECTEXT format
+    Get the text directly under an ElementTree element, like get_tag_text does for minidom
+    :param elem:
     :return:
     """
-    for topic_id in get_dirs(CORPORA_DIR):
+    return (elem.text or '') + ''.join(child.tail or '' for child in elem)
+
 
-        # make directory for every topic
+def iter_trec_docs_minidom(path):
+    """
+    Read (pid, title, abstract) of every PubmedArticle with minidom. Loads the whole file.
+    :param path: str, efetch xml file
+    :return: generator
+    """
+    import xml.dom.minidom
+
+    # open xml
+    with open_compressed(path) as f:
+        dom = xml.dom.minidom.parse(f)
+
+    # get root elements
+    root = dom.documentElement
+
+    # read original downloaded data
+    for r in root.getElementsByTagName('PubmedArticle'):
+        MedlineCitation = r.getElementsByTagName('MedlineCitation')[0]
+        pid = get_tag_text(MedlineCitation, 'PMID')
+        Article = MedlineCitation.getElementsByTagName('Article')[0]
+        title = get_tag_text(Article, 'ArticleTitle')
+        abstract = []
+        abstract_nodes = Article.getElementsByTagName('AbstractText')
+        for abstract_node in abstract_nodes:
+            for node in abstract_node.childNodes:
+                if node.TEXT_NODE == node.nodeType:
+                    abstract.append(node.data)
+        abstract = u'\n'.join(abstract)
+
+        yield pid, title, abstract
+
+
+def iter_trec_docs(path):
+    """
+    Read (pid, title, abstract) of every PubmedArticle with iterparse.
+    Articles are cleared once read, so memory does not grow with the file size.
+    :param path: str, efetch xml file, compressed or not
+    :return: generator
+    """
+    with open_compressed(path) as f:
+        for doc in iter_trec_docs_file(f):
+            yield doc
+
+
+def iter_trec_docs_file(f):
+    """
+    :param f: file object of an efetch xml
+    :return: generator, see iter_trec_docs
+    """
+    context = ET.iterparse(f, events=('start', 'end'))
+    root = next(context)[1]
+
+    for event, r in context:
+        if 'end' != event or 'PubmedArticle' != r.tag:
+            continue
+
+        MedlineCitation = r.find('.//MedlineCitation')
+        pid = get_element_text(MedlineCitation.find('.//PMID'))
+        Article = MedlineCitation.find('.//Article')
+        title = get_element_text(Article.find('.//ArticleTitle'))
+        abstract = []
+        for abstract_node in Article.iter('AbstractText'):
+            abstract.extend(t for t in [abstract_node.text] + [n.tail for n in abstract_node] if t)
+        abstract = u'\n'.join(abstract)
+
+        yield pid, title, abstract
+
+        # free the finished article
+        root.clear()
+
+
+def format_trec_doc(pid, title, abstract):
+    """
+    Make one document TRECTEXT format
+    :param pid:
+    :param title:
+    :param abstract:
+    :return: unicode
+    """
+    return u'<DOC>\n<DOCNO>{}</DOCNO>\n<TITLE>{}</TITLE>\n<TEXT>{}</TEXT>\n</DOC>\n\n'.format(pid, title, abstract)
+
+
+def trec_format_file(src, dst, parser='iterparse'):
+    """
+    Make one downloaded efetch file TRECTEXT format
+    :param src: str, efetch xml file, compressed or not
+    :param dst: str, TRECTEXT file, compressed by the suffix of its name
+    :param parser: str, 'iterparse' or 'minidom'
+    :return: int, document num
+    """
+    iter_docs = iter_trec_docs_minidom if 'minidom' == parser else iter_trec_docs
+    doc_num = 0
+    with open_compressed_text(dst, 'w') as f:
+        for pid, title, abstract in iter_docs(src):
+            # transform to TRECTEXT format
+            f.write(format_trec_doc(pid, title, abstract))
+            doc_num += 1
+    return doc_num
+
+
+def trec_format_text(text, dst):
+    """
+    Make the xml of a corpus block TRECTEXT format
+    :param text: unicode, PubmedArticleSet xml, see corpus_block_text
+    :param dst: str, TRECTEXT file, compressed by the suffix of its name
+    :return: int, document num
+    """
+    doc_num = 0
+    with open_compressed_text(dst, 'w') as f:
+        for pid, title, abstract in iter_trec_docs_file(BytesIO(text.encode('utf-8'))):
+            f.write(format_trec_doc(pid, title, abstract))
+            doc_num += 1
+    return doc_num
+
+
+def trec_format_task(task):
+    """
+    Make one (topic, block) file TRECTEXT format. Runs in a worker process.
+    :param task: tuple, (topic_id, mfile, parser, codec)
+    :return: tuple, (topic_id, mfile, document num, seconds)
+    """
+    topic_id, mfile, parser, codec = task
+    start_time = time.time()
+    dst = compressed_path(os.path.join(TRECTEXT_DIR, topic_id, strip_compression(mfile)), codec)
+    doc_num = trec_format_file(os.path.join(CORPORA_DIR, topic_id, mfile), dst, parser=parser)
+    remove_other_variants(dst)
+    return topic_id, mfile, doc_num, time.time() - start_time
+
+
+def trec_format_store_task(task):
+    """
+    Make one (topic, block) TRECTEXT file straight from the abstract store. Runs in a worker process.
+    :param task: tuple, (topic_id, block, pids, codec)
+    :return: tuple, (topic_id, block, document num, seconds)
+    """
+    topic_id, block, pids, codec = task
+    start_time = time.time()
+    dst = compressed_path(os.path.join(TRECTEXT_DIR, topic_id, block), codec)
+    conn = open_abstract_store()
+    try:
+        text = corpus_block_text(pids, read_stored_abstracts(conn, pids))
+    finally:
+        conn.close()
+    doc_num = trec_format_text(text, dst)
+    remove_other_variants(dst)
+    return topic_id, block, doc_num, time.time() - start_time
+
+
+@timed_stage
+def trec_format_abstract(parser='iterparse', workers=1, packed=False, compress=False, from_store=False):
+    """
+    Make the downloaded abstract TRECTEXT format
+    :param parser: str, 'iterparse' or 'minidom', for the corpora files
+    :param workers: int, processes converting files in parallel
+    :param packed: bool, also write the packed corpus of every topic, see pack_corpora
+    :param compress: bool, zlib compress the packed records
+    :param from_store: bool, read the blocks of every topic straight from the abstract store instead of the
+                       corpora files, e.g. after download_abstract(keep_xml=False)
+    :return:
+    """
+    assert not (from_store and 'minidom' == parser), 'the minidom parser reads corpora files only'
+    manifest = StageManifest('trectext')
+    codec = STAGE_COMPRESSION['trectext']
+    params = {'compression': codec} if codec else None
+
+    def unit(topic_id, mfile):
+        block = strip_compression(mfile)
+        return ('{}/{}'.format(topic_id, block), [os.path.join(CORPORA_DIR, topic_id, mfile)],
+                [compressed_path(os.path.join(TRECTEXT_DIR, topic_id, block), codec)])
+
+    def store_unit(topic_id, block, pids):
+        # the units of stream_abstracts(keep_xml=False), so that either can resume the other
+        store_params = {'stamp': block_stamp(pids, dict_changed)}
+        if codec:
+            store_params['compression'] = codec
+        return ('{}/{}'.format(topic_id, block), [],
+                [compressed_path(os.path.join(TRECTEXT_DIR, topic_id, block), codec)], store_params)
+
+    # remove blocks left by a longer earlier pid list, as download_abstract does for the corpora
+    for topic_id in get_file_ids(PIDS_DIR):
+        removed = remove_stale_blocks(TRECTEXT_DIR, topic_id, read_pids(topic_id))
+        if removed:
+            print('topic {}: removed stale blocks {}'.format(topic_id, ', '.join(sorted(removed))))
+
+    # (topic_id, block file) -> (unit, inputs, outputs, params)
+    dict_unit = {}
+    tasks = []
+    if from_store:
+        conn = open_abstract_store()
+        try:
+            dict_changed = dict(conn.execute('SELECT pmid, changed_at FROM abstract'))
+        finally:
+            conn.close()
+        for topic_id in get_file_ids(PIDS_DIR):
+            for block, pids in enumerate(chunks_by_element(read_pids(topic_id), EFETCH_NUM_PER_TIME)):
+                block = str(block)
+                name, inputs, outputs, unit_params = dict_unit[(topic_id, block)] = store_unit(topic_id, block, pids)
+                if not manifest.is_done(name, inputs, unit_params):
+                    tasks.append((topic_id, block, pids, codec))
+    else:
+        for topic_id in get_dirs(CORPORA_DIR):
+            for mfile in get_file_ids(os.path.join(CORPORA_DIR, topic_id)):
+                name, inputs, outputs, unit_params = dict_unit[(topic_id, mfile)] = unit(topic_id, mfile) + (params,)
+                if not manifest.is_done(name, inputs, unit_params):
+                    tasks.append((topic_id, mfile, parser, codec))
+
+    # make directory for every topic
+    for topic_id in set(task[0] for task in tasks):
         dir_document = os.path.join(TRECTEXT_DIR, str(topic_id))
         if not os.path.exists(dir_document):
             os.makedirs(dir_document)
 
-        for mfile in get_file_ids(os.path.join(CORPORA_DIR, topic_id)):
-
-            with codecs.open(os.path.join(TRECTEXT_DIR, topic_id, mfile), 'w', 'utf-8') as f:
-
-                # open xml
-                dom = xml.dom.minidom.parse(os.path.join(CORPORA_DIR, topic_id, mfile))
-
-                # get root elements
-                root = dom.documentElement
-
-                # read original downloaded data
-                for r in root.getElementsByTagName('PubmedArticle'):
-                    MedlineCitation = r.getElementsByTagName('MedlineCitation')[0]
-                    pid = get_tag_text(MedlineCitation, 'PMID')
-                    Article = MedlineCitation.getElementsByTagName('Article')[0]
-                    title = get_tag_text(Article, 'ArticleTitle')
-                    try:
-                        abstract = []
-                        abstract_nodes = Article.getElementsByTagName('AbstractText')
-                        for abstract_node in abstract_nodes:
-                            for node in abstract_node.childNodes:
-                                if node.TEXT_NODE == node.nodeType:
-                                    abstract.append(node.data)
-                        abstract = u'\n'.join(abstract)
-                    except:
-                        print('AbstractText field does not exist for '.format(pid))
-
-                    # transform to TRECTEXT format
-                    f.write(u'<DOC>\n')
-                    f.write(u'<DOCNO>{}</DOCNO>\n'.format(pid))
-                    f.write(u'<TITLE>{}</TITLE>\n'.format(title))
-                    f.write(u'<TEXT>{}</TEXT>\n'.format(abstract))
-                    f.write(u'</DOC>\n\n')
+    start_time = time.time()
+    doc_sum = 0
+    func = trec_format_store_task if from_store else trec_format_task
+    with run_tasks(func, tasks, workers, ordered=False, manifest=manifest) as results:
+        for i, (topic_id, mfile, doc_num, elapsed) in enumerate(results):
+            name, inputs, outputs, unit_params = dict_unit[(topic_id, mfile)]
+            manifest.mark_done(name, inputs, outputs, unit_params)
+            doc_sum += doc_num
+            # bytes of the corpora file read, or of the TRECTEXT file written from the store
+            RUN_REPORT.record('trec_format_file', elapsed, records=doc_num, topic=topic_id, file=mfile,
+                              bytes=os.path.getsize((inputs or outputs)[0]))
+            print('[{}/{}] topic {} file {}: {} docs in {:.2f}s'.format(i + 1, len(tasks), topic_id, mfile,
+                                                                         doc_num, elapsed))
+
+    elapsed = time.time() - start_time
+    print('formatted {} docs in {:.1f}s ({:.1f} docs/sec)'.format(doc_sum, elapsed, doc_sum / max(elapsed, 1e-6)))
+
+    if packed:
+        pack_corpora(workers=workers, compress=compress)
     return
 
 
+_STREAM_END = object()
 
-def statistics():
+
+def iter_in_thread(iterable, maxsize=STREAM_QUEUE_SIZE):
     """
-    Statistics of the released data
+    Run an iterable, e.g. a generator over the items of an earlier stage, in a background thread
+    and hand its items over through a bounded queue. The thread runs ahead of the consumer by at most
+    maxsize items. An exception of the iterable is raised in the consumer.
+    :param iterable:
+    :param maxsize: int, items waiting in the queue
+    :return: generator, close it to stop the thread early
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((_STREAM_END, None))
+        except Exception as e:
+            put((_STREAM_END, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def consume():
+        try:
+            while True:
+                item, error = queue.get()
+                if item is _STREAM_END:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            # stop a thread blocked on a full queue when the consumer gives up
+            stop.set()
+            thread.join()
+
+    # started now, not on the first item, so that every stage of a chain starts at once
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return consume()
+
+
+def stream_parse(responses):
+    """
+    Parse stage of stream_abstracts
+    :param responses: iterable of (block, pids, content, error), see EfetchClient.fetch_all
+    :return: generator of (block, pids, articles, failed), see parse_efetch_response
+    """
+    for block, pids, content, error in responses:
+        with RUN_REPORT.span('efetch_parse', block=block) as span:
+            articles, failed = parse_efetch_response(block, pids, content, error)
+            span.add(bytes=len(content or b''), records=len(articles))
+        yield block, pids, articles, failed
+
+
+def stream_store(responses, dict_boolean, dict_failed, to_fetch, counts):
+    """
+    Store stage of stream_abstracts. Saves the parsed responses to the abstract store, with its own connection,
+    and yields every corpus block as soon as none of its pids is waiting for a response.
+    :param responses: iterable of (block, pids, articles, failed), see stream_parse
+    :param dict_boolean: dict, topic_id -> list of pids
+    :param dict_failed: dict, efetch entries of the failure queue
+    :param to_fetch: list of str, requested pids
+    :param counts: dict, numbers of docs, changed, failed and recovered pids, updated in place
+    :return: generator of (topic_id, block, pids)
+    """
+    set_fetch = set(to_fetch)
+    dict_waiting = defaultdict(list)  # pid -> blocks waiting for it
+    dict_pending = {}  # block -> number of its pids waiting
+    dict_block = {}
+    list_ready = []
+    for topic_id in sorted(dict_boolean.keys()):
+        for block, pids in enumerate(chunks_by_element(dict_boolean[topic_id], EFETCH_NUM_PER_TIME)):
+            key = (topic_id, block)
+            dict_block[key] = pids
+            dict_pending[key] = 0
+            for pid in pids:
+                if pid in set_fetch:
+                    dict_waiting[pid].append(key)
+                    dict_pending[key] += 1
+            if not dict_pending[key]:
+                list_ready.append(key)
+
+    # blocks of stored pids first
+    for key in list_ready:
+        yield key + (dict_block[key],)
+
+    conn = open_abstract_store()
+    failed, recovered = [], []
+    try:
+        for block, pids, articles, block_failed in responses:
+            with RUN_REPORT.span('efetch_store', block=block) as span:
+                counts['changed'] += store_articles(conn, articles)
+                span.add(records=len(articles))
+            counts['docs'] += len(articles)
+            failed.extend(block_failed)
+            recovered.extend(('efetch', pmid) for pmid, article in articles if pmid in dict_failed)
+
+            for pid in pids:
+                for key in dict_waiting.pop(pid, ()):
+                    dict_pending[key] -= 1
+                    if not dict_pending[key]:
+                        yield key + (dict_block[key],)
+    finally:
+        conn.close()
+        update_failure_queue(add=failed, remove=recovered)
+        counts['failed'] = len(failed)
+        counts['recovered'] = len(recovered)
+
+
+@timed_stage
+def stream_abstracts(api_url=NCBI_API_URL, api_key=NCBI_API_KEY, max_in_flight=EFETCH_MAX_IN_FLIGHT,
+                     refresh_ttl=ABSTRACT_REFRESH_TTL, keep_xml=True, queue_size=STREAM_QUEUE_SIZE):
+    """
+    Download abstract and make them TRECTEXT format in one pass, the streaming mode of
+    download_abstract and trec_format_abstract.
+    Efetch responses flow through bounded queues from the fetching threads to a parse thread, a store thread
+    and the writer, so network, parsing and disk work overlap and at most queue_size items wait between
+    two stages. Every block is written as soon as all its pids are stored or failed.
+    :param api_url: str, efetch endpoint
+    :param api_key: str, NCBI api key
+    :param max_in_flight: int, concurrent efetch requests
+    :param refresh_ttl: float, day. None never fetches a stored article again.
+    :param keep_xml: bool, also write the corpus blocks. Otherwise the xml is only kept in the abstract store.
+    :param queue_size: int, items waiting between two stages
     :return:
     """
-    header = ['TOPIC', 'ITERATION', 'DOCUMENT', 'RELEVANCY']
-    dir_qrel_abs = ABS_QREL_DIR
-    dir_qrel_doc = DOC_QREL_DIR
-    stats = []
+    dict_boolean = {}
+    for topic_id in get_file_ids(PIDS_DIR):
+        dict_boolean[topic_id] = read_pids(topic_id)
+
+    xml_codec = STAGE_COMPRESSION['copora']
+    trec_codec = STAGE_COMPRESSION['trectext']
+    corpora_manifest = StageManifest('corpora')
+    trectext_manifest = StageManifest('trectext')
+    conn = open_abstract_store()
+
+    def write_block(topic_id, block, pids):
+        unit = '{}/{}'.format(topic_id, block)
+        xml_path = compressed_path(os.path.join(CORPORA_DIR, topic_id, str(block)), xml_codec)
+        trec_path = compressed_path(os.path.join(TRECTEXT_DIR, topic_id, str(block)), trec_codec)
+        stamp = block_stamp(pids, read_stored_abstracts(conn, pids, 'changed_at'))
+
+        # the same units as download_abstract and trec_format_abstract, so that either can resume the other
+        xml_params = {'stamp': stamp}
+        if xml_codec:
+            xml_params['compression'] = xml_codec
+        if keep_xml:
+            trec_inputs, trec_params = [xml_path], {}
+        else:
+            trec_inputs, trec_params = [], {'stamp': stamp}
+        if trec_codec:
+            trec_params['compression'] = trec_codec
+        if ((not keep_xml or corpora_manifest.is_done(unit, params=xml_params)) and
+                trectext_manifest.is_done(unit, trec_inputs, trec_params)):
+            return 0
+
+        with RUN_REPORT.span('stream_block', topic=topic_id, block=block) as span:
+            for path in ([xml_path] if keep_xml else []) + [trec_path]:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+            text = corpus_block_text(pids, read_stored_abstracts(conn, pids))
+            if keep_xml:
+                with open_compressed_text(xml_path, 'w') as f:
+                    f.write(text)
+                remove_other_variants(xml_path)
+                corpora_manifest.mark_done(unit, outputs=[xml_path], params=xml_params)
+
+            doc_num = trec_format_text(text, trec_path)
+            remove_other_variants(trec_path)
+            trectext_manifest.mark_done(unit, trec_inputs, [trec_path], trec_params)
+            span.add(bytes=os.path.getsize(trec_path), records=doc_num)
+        return doc_num
+
+    sizer = BatchSizer('efetch', EFETCH_NUM_PER_TIME, EFETCH_NUM_MIN, EFETCH_NUM_MAX, EFETCH_TARGET_TIME,
+                       EFETCH_TARGET_BYTES)
+    client = EfetchClient(api_url=api_url, api_key=api_key, max_in_flight=max_in_flight, sizer=sizer)
+    counts = {'docs': 0, 'changed': 0, 'failed': 0, 'recovered': 0}
+    start_time = time.time()
+    try:
+        dict_failed = read_failure_queue('efetch')
+        to_fetch = select_abstract_pids(conn, dict_boolean, dict_failed, refresh_ttl)
+
+        # fetch -> parse -> store, each in its own thread, -> write in this one
+        responses = iter_in_thread(client.fetch_all(enumerate(sizer.chunks(to_fetch))), queue_size)
+        parsed = iter_in_thread(stream_parse(responses), queue_size)
+        ready = iter_in_thread(stream_store(parsed, dict_boolean, dict_failed, to_fetch, counts), queue_size)
+        block_num = 0
+        doc_sum = 0
+        try:
+            for topic_id, block, pids in ready:
+                doc_num = write_block(topic_id, block, pids)
+                if doc_num:
+                    block_num += 1
+                    doc_sum += doc_num
+        finally:
+            ready.close()
+    finally:
+        client.close()
+        conn.close()
+        corpora_manifest.save()
+        trectext_manifest.save()
+    sizer.summary()
+
+    # remove blocks left by a longer earlier pid list
+    for topic_id, pids in dict_boolean.items():
+        for path in ([CORPORA_DIR] if keep_xml else []) + [TRECTEXT_DIR]:
+            remove_stale_blocks(path, topic_id, pids)
+
+    elapsed = time.time() - start_time
+    print('downloaded {} docs, {} new or changed, {} failed, {} recovered; {} blocks with {} docs written '
+          'in {:.1f}s ({:.1f} docs/sec)'.format(counts['docs'], counts['changed'], counts['failed'],
+                                                counts['recovered'], block_num, doc_sum, elapsed,
+                                                doc_sum / max(elapsed, 1e-6)))
+    return
 
-    print('{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10}'.format(
-        'file name', 'topic', '# total doc', '# abs rel', '# doc rel', '% abs rel', '% doc rel'))
 
-    for topic_id in get_file_ids(dir_qrel_abs):
-        # Read qrels
-        df_abs = pd.read_csv(os.path.join(dir_qrel_abs, topic_id), sep='\s+', names=header)
-        df_content = pd.read_csv(os.path.join(dir_qrel_doc, topic_id), sep='\s+', names=header)
+def sorted_blocks(path):
+    """
+    Get the block files of a topic in block order
+    :param path:
+    :return: list
+    """
+    return sorted(get_file_ids(path), key=lambda mfile: (len(strip_compression(mfile)), mfile))
+
+
+def pack_topic_task(task):
+    """
+    Write the packed corpus of one topic from its TRECTEXT files: PACKED_DIR/<topic>.dat holds the documents
+    as utf-8 records, optionally zlib compressed, the first record of a repeated pmid is kept,
+    and PACKED_DIR/<topic>.idx holds a header (magic, compressed, document num)
+    and the pmid, offset and length columns of the index sorted by pmid. Runs in a worker process.
+    :param task: tuple, (topic_id, compress)
+    :return: tuple, (topic_id, document num, seconds)
+    """
+    topic_id, compress = task
+    start_time = time.time()
+    index = []
+    seen = set()
+    offset = 0
+    with open(os.path.join(PACKED_DIR, '{}.dat'.format(topic_id)), 'wb') as f:
+        for mfile in sorted_blocks(os.path.join(TRECTEXT_DIR, topic_id)):
+            for pid, title, abstract in iter_trectext_docs(os.path.join(TRECTEXT_DIR, topic_id, mfile)):
+                if pid in seen:
+                    continue
+                seen.add(pid)
+                record = format_trec_doc(pid, title, abstract).encode('utf-8')
+                if compress:
+                    record = zlib.compress(record)
+                f.write(record)
+                index.append((int(pid), offset, len(record)))
+                offset += len(record)
+
+    index = np.array(index, dtype=PACKED_INDEX_DTYPE)
+    index.sort(order='pmid')
+    with open(os.path.join(PACKED_DIR, '{}.idx'.format(topic_id)), 'wb') as f:
+        f.write(PACKED_MAGIC)
+        f.write(np.array([int(compress), len(index)], dtype='<u8').tobytes())
+        for name, dtype in PACKED_INDEX_DTYPE:
+            f.write(np.ascontiguousarray(index[name]).tobytes())
+    return topic_id, len(index), time.time() - start_time
+
+
+@timed_stage
+def pack_corpora(workers=1, compress=False):
+    """
+    Write the packed corpus of every topic, for random access by pmid with PackedCorpus
+    :param workers: int, processes packing topics in parallel
+    :param compress: bool, zlib compress the records
+    :return:
+    """
+    if not os.path.exists(PACKED_DIR):
+        os.makedirs(PACKED_DIR)
+    manifest = StageManifest('packed')
+
+    def unit(topic_id):
+        inputs = [os.path.join(TRECTEXT_DIR, topic_id, mfile) for mfile in sorted_blocks(os.path.join(TRECTEXT_DIR,
+                                                                                                      topic_id))]
+        outputs = [os.path.join(PACKED_DIR, '{}.{}'.format(topic_id, ext)) for ext in ['dat', 'idx']]
+        return inputs, outputs, {'compress': compress}
+
+    tasks = [(topic_id, compress) for topic_id in get_dirs(TRECTEXT_DIR)
+             if not manifest.is_done(topic_id, *unit(topic_id)[::2])]
+
+    with run_tasks(pack_topic_task, tasks, workers, manifest=manifest) as results:
+        for topic_id, doc_num, elapsed in results:
+            inputs, outputs, params = unit(topic_id)
+            manifest.mark_done(topic_id, inputs, outputs, params)
+            RUN_REPORT.record('pack_topic', elapsed, bytes=sum(os.path.getsize(path) for path in outputs),
+                              records=doc_num, topic=topic_id)
+            print('packed topic {}: {} docs'.format(topic_id, doc_num))
+    return
+
+
+class PackedCorpus(object):
+    """
+    Random access by pmid to the packed corpus of a topic, see pack_topic_task.
+    Both files are memory-mapped on first use. A lookup is a binary search over the sorted pmid column,
+    touching only a few of its pages, and uncompressed records are returned without a copy.
+    """
+
+    def __init__(self, topic_id, packed_dir=None):
+        """
+        :param topic_id: str
+        :param packed_dir: str, default is PACKED_DIR
+        """
+        self.path = os.path.join(packed_dir or PACKED_DIR, str(topic_id))
+        self.data = None
+        self.index = None  # dict, column name -> array
+        self.compressed = False
+
+    def load(self):
+        """
+        Memory-map the data and index files
+        :return:
+        """
+        if self.index is not None:
+            return
+        with open('{}.idx'.format(self.path), 'rb') as f:
+            header = f.read(24)
+        assert PACKED_MAGIC == header[:8], '{}.idx is not a packed corpus index'.format(self.path)
+        compressed, doc_num = np.frombuffer(header[8:24], dtype='<u8').tolist()
+        self.compressed = bool(compressed)
+
+        index = {}
+        offset = 24
+        for name, dtype in PACKED_INDEX_DTYPE:
+            index[name] = np.memmap('{}.idx'.format(self.path), dtype=dtype, mode='r', offset=offset,
+                                    shape=(doc_num,)) if doc_num else np.zeros(0, dtype=dtype)
+            offset += doc_num * np.dtype(dtype).itemsize
+        self.index = index
+        self.data = np.memmap('{}.dat'.format(self.path), dtype=np.uint8, mode='r') \
+            if os.path.getsize('{}.dat'.format(self.path)) else np.zeros(0, dtype=np.uint8)
+        return
+
+    def __len__(self):
+        self.load()
+        return len(self.index['pmid'])
+
+    def __contains__(self, pmid):
+        return self.position(pmid) is not None
+
+    def pmids(self):
+        """
+        :return: numpy int64 array, sorted pmids
+        """
+        self.load()
+        return self.index['pmid']
+
+    def position(self, pmid):
+        """
+        :param pmid: int or str
+        :return: int, row of the pmid in the index. None if absent.
+        """
+        self.load()
+        pmids = self.index['pmid']
+        i = int(pmids.searchsorted(int(pmid)))
+        if i < len(pmids) and pmids[i] == int(pmid):
+            return i
+        return None
+
+    def get(self, pmid):
+        """
+        Get the TRECTEXT document of a pmid
+        :param pmid: int or str
+        :return: memoryview of the utf-8 record, or bytes if compressed. None if absent.
+        """
+        i = self.position(pmid)
+        if i is None:
+            return None
+        offset, length = int(self.index['offset'][i]), int(self.index['length'][i])
+        record = memoryview(self.data[offset:offset + length])
+        if self.compressed:
+            return zlib.decompress(record.tobytes())
+        return record
+
+    def get_text(self, pmid):
+        """
+        :param pmid: int or str
+        :return: unicode, TRECTEXT document. None if absent.
+        """
+        record = self.get(pmid)
+        if record is None:
+            return None
+        return (record.tobytes() if isinstance(record, memoryview) else record).decode('utf-8')
+
+
+def iter_trectext_docs(path):
+    """
+    Read the documents of a TRECTEXT file written by trec_format_abstract
+    :param path: str, compressed or not
+    :return: generator of (docno, title, text)
+    """
+    with open_compressed_text(path) as f:
+        content = f.read()
+    for match in TRECTEXT_DOC_RE.finditer(content):
+        yield match.groups()
+
+
+def tokenize(text):
+    """
+    :param text: unicode
+    :return: list of lowercased word tokens
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def varint_encode(values):
+    """
+    LEB128 encode non negative integers: 7 bits per byte, the high bit set on every byte but the last of a value
+    :param values: array-like of int
+    :return: bytes
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    shift = np.uint64(7)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> shift
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= shift
+
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    starts = np.cumsum(nbytes) - nbytes
+    for k in range(int(nbytes.max()) if len(values) else 0):
+        sel = nbytes > k
+        byte = (values[sel] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        out[starts[sel] + k] = byte | np.where(nbytes[sel] > k + 1, 0x80, 0).astype(np.uint64)
+    return out.tobytes()
+
+
+def varint_decode(data):
+    """
+    :param data: bytes or uint8 array, see varint_encode
+    :return: numpy uint64 array
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else data
+    ends = np.flatnonzero(data < 0x80)
+    if not len(ends):
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    value_of_byte = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(data)) - starts[value_of_byte]) * 7).astype(np.uint64)
+    # the 7 bit groups of a value do not overlap, so their sum is their bitwise or
+    return np.add.reduceat((data & 0x7f).astype(np.uint64) << shifts, starts)
+
+
+def encode_postings(docids, tfs):
+    """
+    :param docids: sorted array of int
+    :param tfs: array of int, term frequencies
+    :return: bytes, varint docid gaps followed by varint term frequencies
+    """
+    docids = np.asarray(docids, dtype=np.int64)
+    return varint_encode(np.diff(docids, prepend=0) if len(docids) else docids) + varint_encode(tfs)
+
+
+def decode_postings(data):
+    """
+    :param data: bytes or uint8 array, see encode_postings
+    :return: tuple, (int64 array of docids, int64 array of term frequencies)
+    """
+    values = varint_decode(data).astype(np.int64)
+    df = len(values) // 2
+    return np.cumsum(values[:df]), values[df:]
+
+
+def write_index_files(path, postings):
+    """
+    Write the term dictionary and postings of an index or of a segment:
+    terms.txt, the sorted terms one per line, lexicon.npy, the df and postings position of every term,
+    and postings.bin
+    :param path: str, directory
+    :param postings: iterable of (term, docids, tfs), in term order
+    :return: int, term num
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    lexicon = []
+    offset = 0
+    with codecs.open(os.path.join(path, 'terms.txt'), 'w', 'utf-8') as f_terms, \
+            open(os.path.join(path, 'postings.bin'), 'wb') as f_postings:
+        for term, docids, tfs in postings:
+            data = encode_postings(docids, tfs)
+            f_terms.write(term)
+            f_terms.write(u'\n')
+            f_postings.write(data)
+            lexicon.append((len(docids), offset, len(data)))
+            offset += len(data)
+    np.save(os.path.join(path, 'lexicon.npy'), np.array(lexicon, dtype=INDEX_LEXICON_DTYPE))
+    return len(lexicon)
+
+
+def iter_index_files(path):
+    """
+    :param path: str, directory written by write_index_files
+    :return: generator of (term, docids, tfs), in term order
+    """
+    lexicon = np.load(os.path.join(path, 'lexicon.npy'))
+    data = np.fromfile(os.path.join(path, 'postings.bin'), dtype=np.uint8)
+    with codecs.open(os.path.join(path, 'terms.txt'), 'r', 'utf-8') as f:
+        terms = f.read().split(u'\n')
+    for term, (df, offset, length) in zip(terms, lexicon.tolist()):
+        docids, tfs = decode_postings(data[offset:offset + length])
+        yield term, docids, tfs
+
+
+def merge_segments(paths):
+    """
+    Merge the postings of segments written in docid order
+    :param paths: list of segment directories
+    :return: generator of (term, docids, tfs), in term order
+    """
+    def keyed(i, path):
+        # the segment number breaks ties between equal terms, before the arrays are compared
+        for term, docids, tfs in iter_index_files(path):
+            yield term, i, docids, tfs
+
+    merged = heapq.merge(*[keyed(i, path) for i, path in enumerate(paths)])
+    current, list_docids, list_tfs = None, [], []
+    for term, i, docids, tfs in merged:
+        if term != current and list_docids:
+            yield current, np.concatenate(list_docids), np.concatenate(list_tfs)
+            list_docids, list_tfs = [], []
+        current = term
+        list_docids.append(docids)
+        list_tfs.append(tfs)
+    if list_docids:
+        yield current, np.concatenate(list_docids), np.concatenate(list_tfs)
+
+
+def index_task(task):
+    """
+    Build one inverted index in INDEX_DIR/<name>. Runs in a worker process.
+    Documents are indexed in segments of at most INDEX_SEGMENT_POSTINGS (term, document) pairs, written to disk
+    and merged at the end, so memory does not grow with the corpus. A docno repeated in the files is indexed once.
+    Besides the files of write_index_files, the index holds doclen.npy, the token num of every document,
+    docnos.txt, the docno of every docid, and meta.json.
+    :param task: tuple, (name, list of TRECTEXT file paths)
+    :return: tuple, (name, document num, term num, seconds)
+    """
+    name, paths = task
+    start_time = time.time()
+    path = os.path.join(INDEX_DIR, name)
+    tmp_path = '{}.tmp'.format(path)
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    segments = []
+    dict_postings = defaultdict(lambda: ([], []))
+    posting_num = 0
+    doclen = []
+    seen = set()
+
+    def write_segment():
+        segments.append(os.path.join(tmp_path, 'segment_{}'.format(len(segments))))
+        write_index_files(segments[-1], ((term, dict_postings[term][0], dict_postings[term][1])
+                                         for term in sorted(dict_postings.keys())))
+        dict_postings.clear()
+
+    with codecs.open(os.path.join(tmp_path, 'docnos.txt'), 'w', 'utf-8') as f:
+        for src in paths:
+            for docno, title, text in iter_trectext_docs(src):
+                if docno in seen:
+                    continue
+                seen.add(docno)
+                tokens = tokenize(title) + tokenize(text)
+                docid = len(doclen)
+                for term, tf in Counter(tokens).items():
+                    docids, tfs = dict_postings[term]
+                    docids.append(docid)
+                    tfs.append(tf)
+                    posting_num += 1
+                doclen.append(len(tokens))
+                f.write(u'{}\n'.format(docno))
+                if posting_num >= INDEX_SEGMENT_POSTINGS:
+                    write_segment()
+                    posting_num = 0
+    if dict_postings or not segments:
+        write_segment()
+
+    term_num = write_index_files(tmp_path, merge_segments(segments))
+    for segment in segments:
+        shutil.rmtree(segment)
+    doclen = np.array(doclen, dtype=np.uint32)
+    np.save(os.path.join(tmp_path, 'doclen.npy'), doclen)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'docs': len(doclen), 'terms': term_num, 'tokens': int(doclen.sum()),
+                   'segments': len(segments)}, f, sort_keys=True)
+
+    # replace the previous index at once
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return name, len(doclen), term_num, time.time() - start_time
+
+
+@timed_stage
+def build_index(workers=1, global_index=True):
+    """
+    Build the inverted index of the TRECTEXT documents of every topic, and of all topics together
+    :param workers: int, processes building indexes in parallel
+    :param global_index: bool, also build INDEX_DIR/INDEX_GLOBAL over the documents of all topics
+    :return:
+    """
+    manifest = StageManifest('index')
+    dict_paths = {}
+    for topic_id in get_dirs(TRECTEXT_DIR):
+        dict_paths[topic_id] = [os.path.join(TRECTEXT_DIR, topic_id, mfile)
+                                for mfile in sorted_blocks(os.path.join(TRECTEXT_DIR, topic_id))]
+    if global_index:
+        dict_paths[INDEX_GLOBAL] = [path for topic_id in sorted(dict_paths.keys()) for path in dict_paths[topic_id]]
+
+    def outputs(name):
+        return [os.path.join(INDEX_DIR, name, mfile) for mfile in ['terms.txt', 'lexicon.npy', 'postings.bin',
+                                                                    'doclen.npy', 'docnos.txt']]
+
+    tasks = [(name, paths) for name, paths in sorted(dict_paths.items()) if not manifest.is_done(name, paths)]
+
+    with run_tasks(index_task, tasks, workers, manifest=manifest) as results:
+        for name, doc_num, term_num, elapsed in results:
+            manifest.mark_done(name, dict_paths[name], outputs(name))
+            RUN_REPORT.record('index', elapsed, bytes=sum(os.path.getsize(path) for path in outputs(name)),
+                              records=doc_num, index=name)
+            print('index {}: {} docs, {} terms in {:.2f}s'.format(name, doc_num, term_num, elapsed))
+    return
+
 
-        total_num = df_abs.ix[:, 'TOPIC'].count()
-        rel_abs_num = df_abs.loc[df_abs['RELEVANCY'] == 1].ix[:, 'RELEVANCY'].count()
-        rel_content_num = df_content.loc[df_content['RELEVANCY'] == 1].ix[:, 'RELEVANCY'].count()
+class InvertedIndex(object):
+    """
+    Read access and BM25 ranking over an index written by index_task.
+    Postings are memory-mapped and decoded per query term; terms are looked up by binary search.
+    """
 
-        stats.append((total_num, rel_abs_num, rel_content_num))
+    def __init__(self, name, index_dir=None):
+        """
+        :param name: str, topic id or INDEX_GLOBAL
+        :param index_dir: str, default is INDEX_DIR
+        """
+        self.path = os.path.join(index_dir or INDEX_DIR, str(name))
+        self.terms = None
+        self.lexicon = None
+        self.postings_data = None
+        self.doclen = None
+        self.docnos = None
+
+    def load(self):
+        """
+        Read the term dictionary and document table, memory-map the postings
+        :return:
+        """
+        if self.terms is not None:
+            return
+        with codecs.open(os.path.join(self.path, 'terms.txt'), 'r', 'utf-8') as f:
+            self.terms = np.array(f.read().split(u'\n')[:-1], dtype=np.dtype('U'))
+        with codecs.open(os.path.join(self.path, 'docnos.txt'), 'r', 'utf-8') as f:
+            self.docnos = f.read().split(u'\n')[:-1]
+        self.lexicon = np.load(os.path.join(self.path, 'lexicon.npy'))
+        self.doclen = np.load(os.path.join(self.path, 'doclen.npy'))
+        self.postings_data = np.memmap(os.path.join(self.path, 'postings.bin'), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(self.path, 'postings.bin')) else np.zeros(0, dtype=np.uint8)
+        return
+
+    def __len__(self):
+        self.load()
+        return len(self.doclen)
+
+    def term_id(self, term):
+        """
+        :param term: unicode, a token
+        :return: int, row of the term in the lexicon. None if absent.
+        """
+        self.load()
+        i = int(np.searchsorted(self.terms, term))
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def postings(self, term):
+        """
+        :param term: unicode, a token
+        :return: tuple, (int64 array of docids, int64 array of term frequencies)
+        """
+        i = self.term_id(term)
+        if i is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        offset, length = int(self.lexicon['offset'][i]), int(self.lexicon['length'][i])
+        return decode_postings(np.asarray(self.postings_data[offset:offset + length]))
+
+    def bm25(self, query, k1=BM25_K1, b=BM25_B):
+        """
+        :param query: unicode, tokenized like the documents
+        :param k1: float
+        :param b: float
+        :return: float64 array, BM25 score of every docid
+        """
+        self.load()
+        doc_num = len(self.doclen)
+        scores = np.zeros(doc_num)
+        if not doc_num:
+            return scores
+        norm = k1 * (1 - b + b * self.doclen / max(float(self.doclen.mean()), 1e-6))
+        for term, qtf in Counter(tokenize(query)).items():
+            docids, tfs = self.postings(term)
+            if not len(docids):
+                continue
+            idf = math.log(1 + (doc_num - len(docids) + 0.5) / (len(docids) + 0.5))
+            scores[docids] += qtf * idf * tfs * (k1 + 1) / (tfs + norm[docids])
+        return scores
+
+    def search(self, query, depth=None, k1=BM25_K1, b=BM25_B):
+        """
+        Rank the documents by BM25, ties in docid order
+        :param query: unicode
+        :param depth: int, documents returned. None ranks all documents, as a TAR run does.
+        :return: list of (docno, score)
+        """
+        scores = self.bm25(query, k1, b)
+        order = np.argsort(-scores, kind='mergesort')[:depth]
+        return [(self.docnos[i], float(scores[i])) for i in order]
+
+
+@timed_stage
+def bm25_run(path=None, k1=BM25_K1, b=BM25_B, global_index=False, depth=None, tag='bm25'):
+    """
+    Write a TREC run ranking the documents of every topic by BM25 of the review title,
+    a baseline to evaluate against the abs_qrel and doc_qrel files.
+    :param path: str, run file. Default is RUN_DIR/<tag>.
+    :param k1: float
+    :param b: float
+    :param global_index: bool, rank the global corpus instead of the documents of the topic
+    :param depth: int, documents per topic. None ranks all documents.
+    :param tag: str, run name
+    :return: str, path of the run file
+    """
+    path = path or os.path.join(RUN_DIR, tag)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    dict_title = read_title()
+    global_corpus = InvertedIndex(INDEX_GLOBAL) if global_index else None
+
+    with codecs.open(path, 'w', 'utf-8') as f:
+        for topic_id in sorted(name for name in get_dirs(INDEX_DIR) if name in dict_title):
+            # the qrel files name a topic by its review doi
+            qrel_path = os.path.join(ABS_QREL_DIR, topic_id)
+            review_doi = read_qrel_columns(qrel_path)[0] if os.path.exists(qrel_path) else topic_id
+            with RUN_REPORT.span('bm25_topic', topic=topic_id) as span:
+                ranking = (global_corpus or InvertedIndex(topic_id)).search(dict_title[topic_id], depth, k1, b)
+                for rank, (docno, score) in enumerate(ranking):
+                    f.write(u'{} Q0 {} {} {:.6f} {}\n'.format(review_doi, docno, rank + 1, score, tag))
+                span.add(records=len(ranking))
+    print('run {} written to {}'.format(tag, path))
+    return path
+
+
+def read_qrel_columns(path):
+    """
+    Read the pmid and relevance columns of a qrel file
+    :param path: str
+    :return: tuple, (review_doi, numpy int64 array of pmids, numpy int8 array of relevance)
+    """
+    with open(path, 'rb') as f:
+        tokens = f.read().split()
 
+    if len(tokens) % 4:  # lines without a pmid
+        tokens = [token for line in open(path, 'rb') if 4 == len(line.split()) for token in line.split()]
+
+    review_doi = tokens[0].decode('utf-8') if tokens else u''
+    pmids = np.fromstring(b' '.join(tokens[2::4]), dtype=np.int64, sep=' ')
+    relevance = np.fromstring(b' '.join(tokens[3::4]), dtype=np.int8, sep=' ')
+    return review_doi, pmids, relevance
+
+
+def load_qrel_table():
+    """
+    Load all abs and doc qrels into one columnar table: topic code, pmid, abs and doc relevance per row.
+    The table is cached in QREL_TABLE_CACHE_FILE, invalidated when a qrel file changes.
+    :return: dict, 'topic_ids', 'review_dois' (indexed by topic code), 'topic', 'pmid', 'abs', 'doc' arrays
+    """
+    list_topic = get_file_ids(ABS_QREL_DIR)
+    paths = [os.path.join(mdir, topic_id) for topic_id in list_topic for mdir in [ABS_QREL_DIR, DOC_QREL_DIR]]
+    key = json.dumps([[os.path.relpath(path, BASE_DIR), os.path.getsize(path), os.path.getmtime(path)]
+                      for path in paths])
+    cache_path = os.path.join(BASE_DIR, QREL_TABLE_CACHE_FILE)
+
+    try:
+        with np.load(cache_path) as cache:
+            if cache['key'][0] == key:
+                return dict((name, cache[name]) for name in cache.files if 'key' != name)
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+
+    list_doi, list_pmid, list_abs, list_doc, list_code = [], [], [], [], []
+    for code, topic_id in enumerate(list_topic):
+        review_doi, pmids, abs_rel = read_qrel_columns(os.path.join(ABS_QREL_DIR, topic_id))
+        _, doc_pmids, doc_rel = read_qrel_columns(os.path.join(DOC_QREL_DIR, topic_id))
+        assert np.array_equal(pmids, doc_pmids), 'abs and doc qrel of topic {} differ'.format(topic_id)
+        list_doi.append(review_doi)
+        list_pmid.append(pmids)
+        list_abs.append(abs_rel)
+        list_doc.append(doc_rel)
+        list_code.append(np.full(len(pmids), code, dtype=np.int32))
+
+    table = {
+        'topic_ids': np.array(list_topic, dtype=np.str_),
+        'review_dois': np.array(list_doi, dtype=np.str_),
+        'topic': np.concatenate(list_code) if list_code else np.zeros(0, dtype=np.int32),
+        'pmid': np.concatenate(list_pmid) if list_pmid else np.zeros(0, dtype=np.int64),
+        'abs': np.concatenate(list_abs) if list_abs else np.zeros(0, dtype=np.int8),
+        'doc': np.concatenate(list_doc) if list_doc else np.zeros(0, dtype=np.int8),
+    }
+
+    tmp_path = '{}.{}'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, key=np.array([key]), **table)
+    replace_file(tmp_path, cache_path)
+    return table
+
+
+def topic_pmid_pairs(table):
+    """
+    Unique (topic, pmid) pairs of the qrel table, sorted by topic
+    :param table: dict, see load_qrel_table
+    :return: tuple, (topic code array, pmid code array, pmid num)
+    """
+    _, pmid_code = np.unique(table['pmid'], return_inverse=True)
+    pmid_num = int(pmid_code.max()) + 1 if len(pmid_code) else 0
+    pairs = np.unique(table['topic'].astype(np.int64) * max(pmid_num, 1) + pmid_code)
+    return pairs // max(pmid_num, 1), pairs % max(pmid_num, 1), pmid_num
+
+
+def topic_overlap(table):
+    """
+    Number of pmids shared by every pair of topics
+    :param table: dict, see load_qrel_table
+    :return: numpy int64 array, topic num x topic num
+    """
+    topic_num = len(table['topic_ids'])
+    pair_topic, pair_pmid, _ = topic_pmid_pairs(table)
+    bounds = np.searchsorted(pair_topic, np.arange(topic_num + 1))
+
+    overlap = np.zeros((topic_num, topic_num), dtype=np.int64)
+    for i in range(topic_num):
+        codes_i = pair_pmid[bounds[i]:bounds[i + 1]]
+        overlap[i, i] = len(codes_i)
+        for j in range(i + 1, topic_num):
+            overlap[i, j] = overlap[j, i] = len(np.intersect1d(codes_i, pair_pmid[bounds[j]:bounds[j + 1]],
+                                                               assume_unique=True))
+    return overlap
+
+
+@timed_stage
+def statistics(extended=False):
+    """
+    Statistics of the released data
+    :param extended: bool, also print the qrel size distribution and the overlap between topics
+    :return:
+    """
+    table = load_qrel_table()
+    topic_num = len(table['topic_ids'])
+
+    # per topic counts
+    total = np.bincount(table['topic'], minlength=topic_num)
+    rel_abs = np.bincount(table['topic'], weights=(table['abs'] == 1), minlength=topic_num).astype(np.int64)
+    rel_doc = np.bincount(table['topic'], weights=(table['doc'] == 1), minlength=topic_num).astype(np.int64)
+    ratio_abs = rel_abs * 100.0 / np.maximum(total, 1)
+    ratio_doc = rel_doc * 100.0 / np.maximum(total, 1)
+
+    print('{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10}'.format(
+        'file name', 'topic', '# total doc', '# abs rel', '# doc rel', '% abs rel', '% doc rel'))
+
+    for i in range(topic_num):
         # per topic
-        print(r'{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10.2f} | {:<10.2f}'.format(topic_id,
-                                                                    df_abs.iloc[0]['TOPIC'],
-                                                                    total_num,
-                                                                    rel_abs_num,
-                                                                    rel_content_num,
-                                                                    float(rel_abs_num) / total_num * 100,
-                                                                    float(rel_content_num) / total_num * 100))
+        print(r'{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10.2f} | {:<10.2f}'.format(
+            table['topic_ids'][i], table['review_dois'][i], total[i], rel_abs[i], rel_doc[i],
+            ratio_abs[i], ratio_doc[i]))
 
     # in total
-    sum_total_num = sum(total_num for (total_num, rel_abs_num, rel_content_num) in stats)
-    sum_rel_abs_num = sum(rel_abs_num for (total_num, rel_abs_num, rel_content_num) in stats)
-    sum_rel_content_num = sum(rel_content_num for (total_num, rel_abs_num, rel_content_num) in stats)
+    sum_total_num = max(total.sum(), 1)
+    print('')
+    print(r'{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10.2f} | {:<10.2f}'.format(
+        'total', ' ', total.sum(), rel_abs.sum(), rel_doc.sum(),
+        float(rel_abs.sum()) / sum_total_num * 100, float(rel_doc.sum()) / sum_total_num * 100))
+
+    if not extended or 0 == topic_num:
+        return
 
+    # qrel size distribution
+    print('')
+    print('{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10}'.format('per topic', 'min', '25%', 'median', '75%',
+                                                                      'max'))
+    for name, counts in [('# total doc', total), ('# abs rel', rel_abs), ('# doc rel', rel_doc)]:
+        print('{:<10} | {:<10.0f} | {:<10.1f} | {:<10.1f} | {:<10.1f} | {:<10.0f}'.format(
+            name, *np.percentile(counts, [0, 25, 50, 75, 100])))
+
+    # overlap between topics
+    overlap = topic_overlap(table)
+    _, pair_pmid, pmid_num = topic_pmid_pairs(table)
     print('')
-    print(r'{:<10} | {:<10} | {:<10} | {:<10} | {:<10} | {:<10.2f} | {:<10.2f}'.format('total', ' ',
-                                                                  sum_total_num,
-                                                                  sum_rel_abs_num,
-                                                                  sum_rel_content_num,
-                                                                  float(sum_rel_abs_num) / sum_total_num * 100,
-                                                                  float(sum_rel_content_num) / sum_total_num * 100))
+    print('{} unique pmids, {} pmids in more than one topic'.format(
+        pmid_num, int((np.bincount(pair_pmid, minlength=pmid_num) > 1).sum())))
+    print('{:<10} | {:<10} | {:<10}'.format('topic', 'topic', '# shared'))
+    upper = np.triu_indices(topic_num, 1)
+    for k in np.argsort(-overlap[upper], kind='mergesort')[:10]:
+        i, j = upper[0][k], upper[1][k]
+        if overlap[i, j]:
+            print('{:<10} | {:<10} | {:<10}'.format(table['topic_ids'][i], table['topic_ids'][j], overlap[i, j]))
 
     return
 
-if __name__ == '__main__':
-    print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())))
 
-    check_existing()
 
-    batch_download_pid()
-    extract_pid()
-    batch_download_title()
+def read_run_columns(path):
+    """
+    Read the topic and docno columns of a TREC run file. The documents of a topic are ranked in file order.
+    From numpy 1.23 on, np.loadtxt parses the two columns in C, without a python object per token.
+    Files it does not take, e.g. with lines of fewer columns or long topic names, are split in python.
+    :param path: str
+    :return: tuple, (list of topic names, one per stretch of lines of the same topic,
+             numpy int64 array of the stretch of every line, numpy int64 array of pmids)
+    """
+    topics = None
+    if np.lib.NumpyVersion(np.__version__) >= '1.23.0':
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # empty runs
+                rows = np.loadtxt(path, dtype=[('topic', 'S64'), ('docno', np.int64), ('tag', 'S1')],
+                                  usecols=(0, 2, 5), comments=None, encoding='latin-1', ndmin=1)
+        except ValueError:
+            rows = None
+        # a topic name filling the column may have been cut
+        if rows is not None and not (len(rows) and np.char.str_len(rows['topic']).max() == 64):
+            topics, pmids = rows['topic'], rows['docno']
+            words = np.ascontiguousarray(topics).view(np.uint64).reshape(len(topics), 8)  # 8 bytes at a time
+
+    if topics is None:
+        with open(path, 'rb') as f:
+            tokens = f.read().split()
+        if len(tokens) % 6:  # lines without six columns
+            tokens = [token for line in open(path, 'rb') if 6 == len(line.split()) for token in line.split()]
+        topics = np.array(tokens[0::6], dtype=bytes)
+        pmids = np.fromstring(b' '.join(tokens[2::6]), dtype=np.int64, sep=' ')
+        words = topics[:, None]
+
+    # runs list a topic in one stretch of lines, so only the first line of a stretch is decoded
+    change = np.ones(len(topics), dtype=bool)
+    if len(topics):
+        change[1:] = (words[1:] != words[:-1]).any(axis=1)
+    names = [topic.decode('utf-8') for topic in topics[change].tolist()]
+    stretch = np.cumsum(change) - 1
+    return names, stretch, pmids
+
+
+def load_run_columns(path):
+    """
+    read_run_columns of a run file, cached in RUN_CACHE_DIR, invalidated when the run file changes,
+    so that evaluating many runs again reads no run text
+    :param path: str
+    :return: tuple, see read_run_columns
+    """
+    real_path = os.path.realpath(path)
+    key = json.dumps([real_path, os.path.getsize(real_path), os.path.getmtime(real_path)])
+    cache_path = os.path.join(RUN_CACHE_DIR, '{}.npz'.format(
+        hashlib.sha1(json.dumps(real_path).encode('utf-8')).hexdigest()))
+    try:
+        with np.load(cache_path) as cache:
+            if cache['key'][0] == key:
+                return cache['names'].tolist(), cache['stretch'], cache['pmids']
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+
+    names, stretch, pmids = read_run_columns(path)
+    if not os.path.exists(RUN_CACHE_DIR):
+        os.makedirs(RUN_CACHE_DIR)
+    tmp_path = '{}.{}'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, key=np.array([key]), names=np.array(names, dtype='U'), stretch=stretch, pmids=pmids)
+    replace_file(tmp_path, cache_path)
+    return names, stretch, pmids
 
-    make_release_file('topic')
-    make_release_file('abs')
-    make_release_file('doc')
 
-    download_abstract()
+def tar_metrics(group, pmid, group_num, topic_num, qrel_topic, qrel_pmid, qrel_rel, cutoffs=TAR_RECALL_CUTOFFS,
+                wss_levels=TAR_WSS_LEVELS):
+    """
+    TAR metrics of many rankings at once. A group is a (run, topic) pair, coded run * topic num + topic.
+    The documents of a group are ranked in row order, a repeated pmid counts once.
+    recall@k and ap count only the documents in the ranking: a relevant document it misses adds nothing.
+    For last_rel, wss and norm_area, which need every relevant document found, the missed ones are counted
+    at its end, after max(# total doc, ranking length) documents.
+    Groups of topics without relevant documents get nan.
+    :param group: numpy int64 array, group of every ranked row
+    :param pmid: numpy int64 array, pmid of every ranked row
+    :param group_num: int, run num * topic num
+    :param topic_num: int, topics of the qrel table, including those with empty qrels
+    :param qrel_topic: numpy int array, topic code of every qrel row
+    :param qrel_pmid: numpy int64 array
+    :param qrel_rel: numpy bool array, relevance of every qrel row
+    :param cutoffs: list of int, document num of recall@k
+    :param wss_levels: list of float, recall levels of wss
+    :return: dict, metric name -> float array of group_num values:
+             recall@k, wss@level, last_rel (rank of the last relevant document), ap, norm_area
+             (area under the recall curve over the # total doc first ranks, divided by that of a perfect ranking)
+    """
+    topic_num = max(topic_num, 1)
+    group_topic = np.arange(group_num) % topic_num
+    total = np.bincount(qrel_topic, minlength=topic_num)[group_topic].astype(np.float64)
+    rel_num = np.bincount(qrel_topic, weights=qrel_rel, minlength=topic_num)[group_topic]
+
+    # the first row of a repeated pmid: the smallest row of every run of equal keys, sorted by a plain argsort,
+    # which is about twice as fast as the stable one of np.unique
+    shift = np.int64(EVAL_PMID_BITS)
+    keys = (group << shift) | pmid
+    perm = np.argsort(keys)
+    keys = keys[perm]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else \
+        np.zeros(0, dtype=np.int64)
+    first = np.minimum.reduceat(perm, starts) if len(keys) else perm
+    keys = keys[starts]
+
+    # relevance of the unique keys, whose (topic, pmid) keys are sorted within every run, so the search is cache
+    # friendly, put back in row order
+    rel_keys = np.sort((qrel_topic[qrel_rel].astype(np.int64) << shift) | qrel_pmid[qrel_rel])
+    keys -= (keys >> shift) // topic_num * topic_num << shift
+    found = np.zeros(len(group), dtype=bool)
+    if len(rel_keys):
+        found[first] = rel_keys[np.minimum(np.searchsorted(rel_keys, keys), len(rel_keys) - 1)] == keys
+
+    # rank rows within their group
+    first.sort()
+    group, found = group[first], found[first]
+    order = np.argsort(group, kind='mergesort')
+    group, found = group[order], found[order]
+    length = np.bincount(group, minlength=group_num)
+    rank = np.arange(len(group)) - (np.cumsum(length) - length)[group] + 1
+
+    # ranks of the relevant documents, found or missed
+    rel_group, rel_rank = group[found], rank[found]
+    missed = (rel_num - np.bincount(rel_group, minlength=group_num)).astype(np.int64)
+    end = np.maximum(total, length).astype(np.int64)
+    missed_group = np.repeat(np.arange(group_num), missed)
+    missed_rank = end[missed_group] - (np.arange(len(missed_group)) - (np.cumsum(missed) - missed)[missed_group])
+    retrieved = np.concatenate([np.ones(len(rel_group), dtype=bool), np.zeros(len(missed_group), dtype=bool)])
+    rel_group = np.concatenate([rel_group, missed_group])
+    rel_rank = np.concatenate([rel_rank, missed_rank]).astype(np.float64)
+    order = np.lexsort((rel_rank, rel_group))
+    rel_group, rel_rank, retrieved = rel_group[order], rel_rank[order], retrieved[order]
+    start = np.cumsum(rel_num).astype(np.int64) - rel_num.astype(np.int64)
+    nth = np.arange(len(rel_group)) - start[rel_group] + 1
+
+    has_rel = rel_num > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = {}
+        for k in cutoffs:
+            metrics['recall@{}'.format(k)] = np.bincount(rel_group, weights=retrieved & (rel_rank <= k),
+                                                         minlength=group_num) / rel_num
+        for level in wss_levels:
+            # documents read until the level of recall is reached
+            needed = np.maximum(np.ceil(level * rel_num - 1e-9), 1).astype(np.int64)
+            read = np.where(has_rel, rel_rank[np.minimum(start + needed - 1, max(len(rel_rank) - 1, 0))], np.nan) \
+                if len(rel_rank) else np.full(group_num, np.nan)
+            metrics['wss@{:g}'.format(level)] = (total - read) / total - (1 - level)
+        metrics['last_rel'] = np.where(has_rel, rel_rank[np.maximum(start + rel_num.astype(np.int64) - 1, 0)]
+                                       if len(rel_rank) else np.nan, np.nan)
+        metrics['ap'] = np.bincount(rel_group, weights=retrieved * nth / rel_rank, minlength=group_num) / rel_num
+        area = np.bincount(rel_group, weights=np.maximum(total[rel_group] - rel_rank + 1, 0), minlength=group_num)
+        metrics['norm_area'] = area / (rel_num * total - rel_num * (rel_num - 1) / 2)
+    for name in metrics:
+        metrics[name][~has_rel] = np.nan
+    return metrics
+
+
+@timed_stage
+def evaluate_runs(paths, qrel_type='abs', cutoffs=TAR_RECALL_CUTOFFS, wss_levels=TAR_WSS_LEVELS,
+                  batch_rows=EVAL_BATCH_ROWS):
+    """
+    Evaluate TREC run files against the abs or doc qrels with TAR metrics, see tar_metrics.
+    Runs are read into integer-coded arrays, cached by load_run_columns, and evaluated together,
+    batch_rows rows at a time.
+    Topics of a run that are not in the qrels are ignored.
+    :param paths: list of run files
+    :param qrel_type: str, 'abs' or 'doc'
+    :param cutoffs: list of int, document num of recall@k
+    :param wss_levels: list of float, recall levels of wss
+    :param batch_rows: int, run rows evaluated at once
+    :return: tuple, (numpy array of review dois, dict, metric name -> float array [run, topic])
+    """
+    table = load_qrel_table()
+    topic_num = len(table['review_dois'])
+    dict_code = dict((review_doi, code) for code, review_doi in enumerate(table['review_dois'].tolist()))
+    qrel_rel = table[qrel_type] > 0
+    results = {}
+
+    def evaluate(batch, first):
+        group = np.concatenate([g for g, p in batch]) if batch else np.zeros(0, dtype=np.int64)
+        pmid = np.concatenate([p for g, p in batch]) if batch else np.zeros(0, dtype=np.int64)
+        with RUN_REPORT.span('evaluate_batch', runs=len(batch)) as span:
+            metrics = tar_metrics(group, pmid, len(batch) * topic_num, topic_num, table['topic'], table['pmid'],
+                                  qrel_rel, cutoffs, wss_levels)
+            span.add(records=len(group))
+        for name, values in metrics.items():
+            if name not in results:
+                results[name] = np.full((len(paths), topic_num), np.nan)
+            results[name][first:first + len(batch)] = values.reshape(len(batch), topic_num)
+
+    batch, first, row_num = [], 0, 0
+    for i, path in enumerate(paths):
+        names, stretch, pmids = load_run_columns(path)
+        codes = np.array([dict_code.get(name, -1) for name in names], dtype=np.int64)[stretch]
+        known = codes >= 0
+        batch.append(((i - first) * topic_num + codes[known], pmids[known]))
+        row_num += int(known.sum())
+        if row_num >= batch_rows or i == len(paths) - 1:
+            evaluate(batch, first)
+            batch, first, row_num = [], i + 1, 0
+    if not paths:
+        evaluate([], 0)
+    return table['review_dois'], results
+
+
+def print_evaluation(paths, review_dois, results, per_topic=False):
+    """
+    Print the mean of every metric over the topics with relevant documents, per run
+    :param paths: list of run files
+    :param review_dois: numpy array, see evaluate_runs
+    :param results: dict, see evaluate_runs
+    :param per_topic: bool, also print every topic of a single run
+    :return:
+    """
+    names = sorted(results.keys(), key=lambda name: (name.split('@')[0], float(name.split('@')[1])
+                                                     if '@' in name else 0))
+    print('{:<24} | {}'.format('run', ' | '.join('{:<10}'.format(name) for name in names)))
+    for i, path in enumerate(paths):
+        line = []
+        for name in names:
+            values = results[name][i]
+            values = values[~np.isnan(values)]
+            line.append('{:<10.4f}'.format(values.mean() if len(values) else float('nan')))
+        print('{:<24} | {}'.format(os.path.basename(path), ' | '.join(line)))
+        if per_topic and 1 == len(paths):
+            for j, review_doi in enumerate(review_dois.tolist()):
+                print('{:<24} | {}'.format(review_doi, ' | '.join('{:<10.4f}'.format(results[name][i, j])
+                                                                  for name in names)))
+    return
 
-    statistics()
\ No newline at end of file
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=1, help='processes for parallel stages')
+    common.add_argument('--force', action='store_true', help='redo units completed by earlier runs')
+    common.add_argument('--compression', action='append', default=[], metavar='[STAGE=]CODEC',
+                        help='compress the files of download_pids, copora or trectext with gzip or zstd, '
+                             'e.g. copora=zstd. Without a stage all three. May be repeated.')
+    common.add_argument('--report-dir', default=REPORT_DIR, help='directory of the run report')
+    common.add_argument('--profile', choices=['cprofile', 'pyinstrument'],
+                        help='profile the run, the output is written next to the run report')
+
+    arg_parser = argparse.ArgumentParser(description='Data collection for CLEF eHealth 2017 TAR')
+    commands = arg_parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    def add_command(name, description, run):
+        command = commands.add_parser(name, parents=[common], help=description, description=description)
+        command.set_defaults(run=run)
+        return command
+
+    def add_fetch_options(command):
+        command.add_argument('--refresh-ttl', type=float, default=ABSTRACT_REFRESH_TTL,
+                             help='fetch stored abstracts older than this many days again')
+        command.add_argument('--max-in-flight', type=int, default=EFETCH_MAX_IN_FLIGHT,
+                             help='concurrent efetch requests')
+        command.add_argument('--no-corpora', action='store_true',
+                             help='keep the downloaded xml only in the abstract store, not in copora files')
+
+    def add_packed(command):
+        command.add_argument('--packed', action='store_true', help='also write packed corpora for random access')
+        command.add_argument('--compress', action='store_true', help='zlib compress the packed corpora')
+
+    def run_all(args):
+        batch_download_pid()
+        extract_pid(workers=args.workers)
+        batch_download_title()
+
+        make_release_files(workers=args.workers)
+
+        if args.stream:
+            stream_abstracts(max_in_flight=args.max_in_flight, refresh_ttl=args.refresh_ttl,
+                             keep_xml=not args.no_corpora)
+            if args.packed:
+                pack_corpora(workers=args.workers, compress=args.compress)
+        else:
+            download_abstract(max_in_flight=args.max_in_flight, refresh_ttl=args.refresh_ttl,
+                              keep_xml=not args.no_corpora)
+            trec_format_abstract(workers=args.workers, packed=args.packed, compress=args.compress,
+                                 from_store=args.no_corpora)
+        if args.index:
+            build_index(workers=args.workers)
+            bm25_run()
+
+        statistics()
+
+    def run_drain(args):
+        batch_download_pid(only_failed=True)
+        batch_download_title()
+        download_abstract(only_failed=True)
+
+    command = add_command('all', 'run the whole pipeline, the default command', run_all)
+    add_fetch_options(command)
+    command.add_argument('--stream', action='store_true',
+                         help='download the abstracts and make them TRECTEXT format in one overlapped pass')
+    add_packed(command)
+    command.add_argument('--index', action='store_true',
+                         help='build the inverted indexes of the TRECTEXT documents and a BM25 baseline run')
+
+    add_command('pids', 'download the pids of all the systematic reviews from Ovid',
+                lambda args: batch_download_pid())
+    add_command('extract', 'extract the pids that satisfy the date constraint',
+                lambda args: extract_pid(workers=args.workers))
+    add_command('title', 'download the titles of all the systematic reviews',
+                lambda args: batch_download_title())
+    add_command('release', 'make the topic files and the abs and doc qrel files',
+                lambda args: make_release_files(workers=args.workers))
+
+    command = add_command('fetch', 'download the abstracts of all the pids',
+                          lambda args: download_abstract(max_in_flight=args.max_in_flight,
+                                                         refresh_ttl=args.refresh_ttl,
+                                                         keep_xml=not args.no_corpora))
+    add_fetch_options(command)
+
+    command = add_command('format', 'make the downloaded abstracts TRECTEXT format',
+                          lambda args: trec_format_abstract(parser=args.parser, workers=args.workers,
+                                                            packed=args.packed, compress=args.compress,
+                                                            from_store=args.from_store))
+    command.add_argument('--parser', choices=['iterparse', 'minidom'], default='iterparse',
+                         help='xml parser of the corpora files')
+    command.add_argument('--from-store', action='store_true',
+                         help='read the abstracts straight from the abstract store, after fetch --no-corpora')
+    add_packed(command)
+
+    command = add_command('stream', 'download the abstracts and make them TRECTEXT format in one pass',
+                          lambda args: stream_abstracts(max_in_flight=args.max_in_flight,
+                                                        refresh_ttl=args.refresh_ttl,
+                                                        keep_xml=not args.no_corpora))
+    add_fetch_options(command)
+
+    command = add_command('pack', 'pack the TRECTEXT documents of each topic for random access by pmid',
+                          lambda args: pack_corpora(workers=args.workers, compress=args.compress))
+    command.add_argument('--compress', action='store_true', help='zlib compress the packed corpora')
+
+    command = add_command('index', 'build the inverted index of every topic and of the global corpus',
+                          lambda args: build_index(workers=args.workers, global_index=not args.no_global))
+    command.add_argument('--no-global', action='store_true', help='only build the indexes of the topics')
+
+    command = add_command('bm25', 'rank the documents of every topic with BM25 into a TREC run file',
+                          lambda args: bm25_run(path=args.output, k1=args.k1, b=args.b,
+                                                global_index=args.global_index, depth=args.depth,
+                                                tag=args.tag))
+    command.add_argument('--output', help='run file, default is {}/<tag>'.format(RUN_DIR))
+    command.add_argument('--k1', type=float, default=BM25_K1)
+    command.add_argument('--b', type=float, default=BM25_B)
+    command.add_argument('--global-index', action='store_true',
+                         help='rank the global corpus instead of the documents of the topic')
+    command.add_argument('--depth', type=int, help='documents per topic, default all')
+    command.add_argument('--tag', default='bm25', help='run name')
+
+    command = add_command('evaluate', 'evaluate TREC run files against the qrels',
+                          lambda args: print_evaluation(args.runs, *evaluate_runs(args.runs,
+                                                                                  qrel_type=args.qrel_type),
+                                                        per_topic=True))
+    command.add_argument('runs', nargs='+', metavar='RUN', help='TREC run file')
+    command.add_argument('--qrel-type', choices=['abs', 'doc'], default='abs', help='qrels to evaluate against')
+
+    command = add_command('stats', 'statistics of the released data',
+                          lambda args: statistics(extended=args.extended))
+    command.add_argument('--extended', action='store_true',
+                         help='also print the qrel size distribution and the overlap between topics')
+
+    add_command('drain', 'only retry the Ovid topics, titles and pmids in the failure queue', run_drain)
+
+    # without a command, the options are those of the whole pipeline
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in commands.choices and argv[0] not in ('-h', '--help'):
+        named = [value for value in argv if value in commands.choices]
+        if named:
+            arg_parser.error('the command comes before the options: {} {}'.format(
+                named[0], ' '.join(value for value in argv if value != named[0])))
+        argv = ['all'] + argv
+    args = arg_parser.parse_args(argv)
+    RESUME = not args.force
+    for value in args.compression:
+        stage, _, codec = value.rpartition('=')
+        if codec not in COMPRESSION_SUFFIXES or (stage and stage not in STAGE_COMPRESSION):
+            arg_parser.error('invalid --compression {}'.format(value))
+        for name in ([stage] if stage else list(STAGE_COMPRESSION.keys())):
+            STAGE_COMPRESSION[name] = codec
+
+    print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())))
+
+    check_existing()
+
+    try:
+        if args.profile:
+            if not os.path.exists(args.report_dir):
+                os.makedirs(args.report_dir)
+            run_profiled(lambda: args.run(args), args.profile, os.path.join(args.report_dir, 'profile_{}'.format(
+                time.strftime('%Y%m%d_%H%M%S', time.localtime(RUN_REPORT.start_time)))))
+        else:
+            args.run(args)
+    finally:
+        print('run report written to {}'.format(RUN_REPORT.write(args.report_dir)))